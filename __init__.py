@@ -1,15 +1,38 @@
 __all__ = [
     'set_database',
     'set_thresholds',
+    'use_flat_tree',
+    'use_apk_tree',
+    'set_result_cache',
+    'enable_similarity_index',
+    'enable_lib_filter',
+    'enable_stats',
+    'disable_stats',
+    'get_stats',
+    'reset_stats',
     'detect_dex_libraries',
     'detect_exact_dex_libraries',
     'detect_apk_libraries',
     'detect_exact_apk_libraries',
+    'detect_apk_libraries_batch',
+    'detect_exact_apk_libraries_batch',
+    'detect_dex_libraries_async',
+    'detect_exact_dex_libraries_async',
+    'detect_apk_libraries_async',
+    'detect_exact_apk_libraries_async',
+    'analyze_dex',
+    'analyze_apk',
+    'Analysis',
     'add_dex_to_database',
     'remove_dex_from_database',
     'add_apk_to_database',
     'remove_apk_from_database',
+    'add_apks_to_database',
+    'add_dex_to_database_async',
+    'add_apk_to_database_async',
+    'add_analysis_to_database',
     'update_library_database',
+    'refresh_database',
     'dump_database',
     'load_database'
 ]
@@ -19,22 +42,60 @@ from common import *
 
 from .stub import *
 from .pkgtree import PackageTree
+from .flattree import FlatPackageTree
+from .cache import ResultCache, dex_signature
 from . import filterlibs
+from . import stats
+from . import lsh
+from . import bloom
 
 from . import thresholds as _thresholds
 
+# asyncio, concurrent.futures and multiprocessing are imported by functions using them;
+# importing them here would more than double the time to import this package
+from array import array
+from typing import Awaitable, Callable, Collection, Iterator, Tuple
+import copy
+import hashlib
+import os
+import traceback
+
 _db: Database
 if False:
     from . import sqldb
     _db = cast(Database, sqldb)
 else:
     from . import memdb
-    _db = cast(Database, memdb)
-    _db.load()
+    _db = cast(Database, memdb)  # loaded on first use
+
+_tree_class: Any = PackageTree
+_apk_tree = False
+_result_cache: Optional[ResultCache] = None
+
+# near matches are reported only when enabled; the index is built on first use
+_use_similarity = False
+_similarity_index: Optional[lsh.SimilarityIndex] = None
+
+# library hashes are prefiltered only when enabled; the filter is loaded or built on first use
+_use_lib_filter = False
+_lib_filter_rate = 0.01
+_lib_filter_max_bytes: Optional[int] = None
+_lib_filter: Optional[bloom.BloomFilter] = None
+
+##  Attributes of database modules naming their file, which identifies the database a library filter is built from
+_DbFileAttributes = [ 'database_file', 'snapshot_file', 'socket_path' ]
+
+# synchronous database functions called by async API run in this thread, one at a time,
+# so the event loop keeps building trees meanwhile
+_db_executor: Optional['concurrent.futures.ThreadPoolExecutor'] = None
+
+# digests of APKs added to database by previous runs of `add_apks_to_database`
+_ingested: Set[str] = set()
 
 
 def set_database(db: Any):
     """Use a custom database
+    An `AsyncDatabase` can only be used by async functions
     If this function is never called, use the OrangeAPK MySQL database when available,
     or fallback to in-memory database when not
     This function must be called before any analyzer function
@@ -51,20 +112,164 @@ def set_thresholds(thresholds: Thresholds):
         value = getattr(thresholds, key)
         setattr(_thresholds, key, value)
 
+def use_flat_tree(enabled: bool = True) -> None:
+    """Use array-backed `FlatPackageTree` instead of `PackageTree` to analyze dex files
+    The results are identical; flat tree uses less memory and no recursion on large dex files
+    """
+    global _tree_class
+    _tree_class = FlatPackageTree if enabled else PackageTree
+
+def use_apk_tree(enabled: bool = True) -> None:
+    """Analyze all dex files of an APK as one tree in APK functions (detection and database)
+    Packages split across dex files, common in multidex apps, then get the same hashes as in
+    single-dex apps, and each APK is hashed, looked up and matched only once.
+    Build the database in the same mode: hashes of split packages differ between modes.
+    """
+    global _apk_tree
+    _apk_tree = enabled
+
+def set_result_cache(cache: Optional[ResultCache]) -> None:
+    """Reuse detection results of dex files with identical signature
+    Results are keyed on the database and its generation, hash scheme and thresholds,
+    so changing any of them never returns stale results.
+    Pass a `ResultCache` (which can be saved to and loaded from disk), or None to disable
+    """
+    global _result_cache
+    _result_cache = cache
+
+def enable_similarity_index(enabled: bool = True) -> None:
+    """Also report packages similar to libraries, using MinHash signatures of their API sets (see lsh.py)
+    Once enabled, signatures of packages added to database are recorded (if the database supports it),
+    and `update_library_database` builds the index from signatures of libraries.
+    `detect_dex_libraries` then reports the most similar library of each package without a match,
+    with estimated Jaccard similarity of API sets (at least `MinSimilarity` threshold) as similarity.
+    """
+    global _use_similarity, _similarity_index
+    _use_similarity = enabled
+    _similarity_index = None
+
+def enable_lib_filter(enabled: bool = True, false_positive_rate: float = 0.01, max_bytes: Optional[int] = None) -> None:
+    """Only look up package hashes which may be libraries, using a Bloom filter of all library hashes
+    Useful for remote databases: most package hashes are app-specific, and are no longer sent.
+    The filter is sized for `false_positive_rate`, but is at most `max_bytes` (at a higher rate).
+    It is built by `update_library_database` (if the database supports `get_lib_hashes`) and saved to
+    `bloom.filter_file`, which later processes load. A filter of another database, or older than the
+    library database (e.g. updated by another process), is rebuilt on first use. A database without
+    `generation` only gets a filter in memory, which is rebuilt by `update_library_database`.
+    See `get_stats` for its size and rate.
+    """
+    global _use_lib_filter, _lib_filter_rate, _lib_filter_max_bytes, _lib_filter
+    _use_lib_filter = enabled
+    _lib_filter_rate = false_positive_rate
+    _lib_filter_max_bytes = max_bytes
+    _lib_filter = None
+
+def enable_stats(callback: Optional[Callable[[str, Dict[str, float]], None]] = None) -> None:
+    """Record time of each phase (tree building, hashing, database lookup, matching, ...) and counters
+    If `callback` is given, it is called with the name and values of each recorded phase or counter,
+    e.g. `('db.match_libs', { 'wall': 0.02, 'cpu': 0.01 })` or `('tree.nodes', { 'count': 1234 })`.
+    Worker processes of batch functions keep their own stats, which are not collected.
+    """
+    stats.enable(callback)
+
+def disable_stats() -> None:
+    stats.disable()
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    """Get recorded stats: `phases` maps name to calls, wall and CPU seconds; `counters` maps name to count;
+    `caches` maps name of enabled caches to their size and hit counts;
+    `lib_filter` is the size and expected false positive rate of library filter, if loaded
+    """
+    ret = stats.get_stats()
+    if _lib_filter is not None:
+        ret['lib_filter'] = _lib_filter.stats()
+    ret['caches'] = { }
+    if _result_cache is not None:
+        ret['caches']['result_cache'] = _result_cache.stats()
+    return ret
+
+def reset_stats() -> None:
+    stats.reset_stats()
+    if _result_cache is not None:
+        _result_cache.hits = _result_cache.misses = 0
+
+
 def preload_database():
     """Pre-download database to memory (for SQL database)"""
     _db.preload()
 
+def refresh_database() -> None:
+    """Download library database changes made by other processes (for SQL database)
+    Call this periodically in long-running services
+    """
+    _db.refresh()
+
 
 def detect_dex_libraries(dex: Dex) -> List[PkgResult]:
     """Detect third-party libraries in a dex file
     Return the mapping from original package name to standard library name.
     If a package and some of its subpackages match libraries at the same time,
     """
-    tree = PackageTree(dex, _db.api_set)
-    libs = _db.match_libs(tree.nodes.keys())
-    tree.set_db_match_result(libs)
-    return tree.detect_libs(_thresholds.LibMatchRate, _db.lib_set)
+    return _cached_result(dex, _detect_dex_libraries)
+
+def _detect_dex_libraries(dex: Dex) -> List[PkgResult]:
+    tree = _build_tree(dex, _use_similarity)
+    tree.set_db_match_result(_match_libs(tree))
+    return _gen_results(tree, _tree_signatures(tree))
+
+def _tree_signatures(tree: PackageTree) -> Dict[str, array]:
+    """Get signatures of packages by name from APIs collected while building the tree, if similarity index is enabled"""
+    return lsh.pkg_signatures(tree.pkg_apis) if _use_similarity else { }
+
+def _gen_results(tree: PackageTree, signatures: Dict[str, array]) -> List[PkgResult]:
+    """`signatures` are MinHash signatures of packages by name, only used if similarity index is enabled"""
+    ret = tree.detect_libs(_thresholds.LibMatchRate, _db.lib_set)
+    if _use_similarity:
+        ret += _detect_similar_libraries(signatures, tree, ret)
+    return ret
+
+def _detect_similar_libraries(signatures: Dict[str, array], tree: PackageTree, results: List[PkgResult]) -> List[PkgResult]:
+    global _similarity_index
+    if _similarity_index is None:
+        _similarity_index = _build_similarity_index()
+    if len(_similarity_index) == 0:
+        return [ ]
+
+    ret = [ ]
+    with stats.phase('similarity'):
+        # exact matches and their subpackages are left out of results, but are not near matches either
+        for pkg in tree.unmatched_pkgs({ result.hash for result in results }):
+            if not _is_recordable(pkg): continue
+            signature = signatures.get(pkg.name)
+            if signature is None: continue  # class
+            candidates = _similarity_index.query(signature, _thresholds.MinSimilarity)
+            if len(candidates) == 0: continue
+            similarity, lib = candidates[0]
+            names = _similarity_index.names[lib]
+            ret.append(PkgResult(pkg.hash, pkg.name, pkg.name if pkg.name in names else names[0], similarity))
+    if stats.enabled:
+        stats.count('similarity.matches', len(ret))
+    return ret
+
+def _build_similarity_index() -> lsh.SimilarityIndex:
+    if not hasattr(_db, 'get_lib_signatures'):
+        lx.warning('Database does not record signatures, similarity index is empty')
+        return lsh.SimilarityIndex([ ])
+    with stats.phase('similarity.build'):
+        return lsh.SimilarityIndex(_db.get_lib_signatures())
+
+def _get_records(dex: Dex) -> Tuple[List[PkgInfo], Dict[bytes, bytes]]:
+    """Get packages to record, and their signatures if similarity index is enabled"""
+    tree = _build_tree(dex, _use_similarity)
+    pkgs = [ pkg for pkg in tree.pkgs() if _is_recordable(pkg) ]
+    return pkgs, _pkg_signatures(_tree_signatures(tree), pkgs)
+
+def _pkg_signatures(signatures: Dict[str, array], pkgs: List[PkgInfo]) -> Dict[bytes, bytes]:
+    return { pkg.hash : lsh.to_bytes(signatures[pkg.name]) for pkg in pkgs if pkg.name in signatures }
+
+def _add_signatures(signatures: Dict[bytes, bytes]) -> None:
+    if len(signatures) > 0 and hasattr(_db, 'add_signatures'):
+        _db.add_signatures(signatures)
 
 def detect_exact_dex_libraries(dex: Dex) -> Dict[str, str]:
     """Detect perfectly matched third-party libraries in a dex file
@@ -72,19 +277,169 @@ def detect_exact_dex_libraries(dex: Dex) -> Dict[str, str]:
     If a package and some of its subpackages match libraries at the same time,
     only the top-level package will be reported.
     """
-    tree = PackageTree(dex, _db.api_set)
-    libs = _db.match_libs(tree.nodes.keys())
-    tree.set_db_match_result(libs)
+    return _cached_result(dex, _detect_exact_dex_libraries)
+
+def _detect_exact_dex_libraries(dex: Dex) -> Dict[str, str]:
+    tree = _build_tree(dex)
+    tree.set_db_match_result(_match_libs(tree))
     return tree.detect_exact_libs()
 
 
+def analyze_dex(dex: Dex) -> 'Analysis':
+    """Build the package tree of a dex file and look it up in database once
+    Detection results and database records are derived from the returned `Analysis`,
+    instead of rebuilding the tree in each of `detect_dex_libraries`, `detect_exact_dex_libraries`
+    and `add_dex_to_database`.
+    """
+    tree = _build_tree(dex, _use_similarity)
+    tree.set_db_match_result(_match_libs(tree))
+    return Analysis(dex, tree)
+
+def analyze_apk(apk_file: Union[bytes, str]) -> List['Analysis']:
+    """Analyze each dex file of an APK (or the APK as one dex if APK tree is enabled), see `analyze_dex`"""
+    return [ analyze_dex(dex) for dex in _apk_dexes(apk_file) ]
+
+
+class Analysis:
+    """Package tree of a dex file matched against database, see `analyze_dex`
+    `pkgs` and `signatures` are the records `add_dex_to_database` would write.
+    Detection results are calculated on first use, with thresholds and whitelist of that time.
+    An analysis can be pickled, e.g. to detect on one machine and add to database on another;
+    pickling calculates all results and drops the tree, which is much larger.
+    """
+
+    def __init__(self, dex: Dex, tree: PackageTree) -> None:
+        self.hash_scheme: int = getattr(_db, 'hash_scheme', 1)
+        self.pkgs: List[PkgInfo] = [ pkg for pkg in tree.pkgs() if _is_recordable(pkg) ]
+        self._dex_signatures: Dict[str, array] = _tree_signatures(tree)
+        self.signatures: Dict[bytes, bytes] = _pkg_signatures(self._dex_signatures, self.pkgs)
+        self._tree: Optional[PackageTree] = tree
+        self._exact_libs: Optional[Dict[str, str]] = None
+        self._libs: Optional[List[PkgResult]] = None
+
+    def exact_libs(self) -> Dict[str, str]:
+        """Same as `detect_exact_dex_libraries`"""
+        if self._exact_libs is None:
+            self._exact_libs = cast(PackageTree, self._tree).detect_exact_libs()
+        return dict(self._exact_libs)
+
+    def libs(self) -> List[PkgResult]:
+        """Same as `detect_dex_libraries`"""
+        if self._libs is None:
+            self.exact_libs()  # calculating match rates adds partial matches to the tree
+            self._libs = _gen_results(cast(PackageTree, self._tree), self._dex_signatures)
+        return list(self._libs)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.libs()
+        state = dict(self.__dict__)
+        state['_tree'] = None
+        state['_dex_signatures'] = { }
+        return state
+
+
+def _match_libs(tree: PackageTree) -> List[LibInfo]:
+    hashes = _filter_hashes(tree.nodes.keys())
+    with stats.phase('db.match_libs'):
+        libs = _db.match_libs(hashes)
+    if stats.enabled:
+        stats.count('db.match_libs.hashes', len(hashes))
+        stats.count('db.match_libs.rows', len(libs))
+    return libs
+
+def _filter_hashes(hashes: Collection[bytes]) -> Collection[bytes]:
+    """Drop hashes which are not libraries, if library filter is enabled"""
+    lib_filter = _get_lib_filter()
+    if lib_filter is None:
+        return hashes
+    with stats.phase('lib_filter'):
+        ret = lib_filter.filter(hashes)
+    if stats.enabled:
+        stats.count('lib_filter.hashes', len(hashes))
+        stats.count('lib_filter.passed', len(ret))
+    return ret
+
+def _get_lib_filter() -> Optional[bloom.BloomFilter]:
+    global _lib_filter
+    if not _use_lib_filter:
+        return None
+    state = _lib_filter_state()
+    if _lib_filter is not None and (_lib_filter.database, _lib_filter.hash_scheme, _lib_filter.generation) == state:
+        return _lib_filter
+
+    _lib_filter = None
+    if _persist_lib_filter() and os.path.exists(bloom.filter_file):
+        try:
+            lib_filter = bloom.read(bloom.filter_file)
+            if (lib_filter.database, lib_filter.hash_scheme, lib_filter.generation) == state:
+                _lib_filter = lib_filter
+        except ValueError as e:
+            lx.warning('Rebuilding library filter: %s' % e)
+    if _lib_filter is None:
+        _lib_filter = _build_lib_filter()
+    return _lib_filter
+
+def _lib_filter_state() -> Tuple[str, int, int]:
+    """Identity, hash scheme and generation of database, which a library filter or cached result must come from"""
+    database = getattr(_db, '__name__', type(_db).__name__)
+    for name in _DbFileAttributes:
+        path = getattr(_db, name, None)
+        if isinstance(path, str):
+            database += ':' + os.path.abspath(path)
+            break
+    return database, getattr(_db, 'hash_scheme', 1), getattr(_db, 'generation', 0)
+
+def _persist_lib_filter() -> bool:
+    """Whether library filter file can be used: it could not be checked for staleness without database generation"""
+    return hasattr(_db, 'generation')
+
+def _build_lib_filter() -> Optional[bloom.BloomFilter]:
+    """Build library filter from database and save it, or disable it if the database does not support it"""
+    global _use_lib_filter
+    if not hasattr(_db, 'get_lib_hashes'):
+        lx.warning('Database cannot list library hashes, library filter is disabled')
+        _use_lib_filter = False
+        return None
+    with stats.phase('lib_filter.build'):
+        ret = bloom.build(list(_db.get_lib_hashes()), _lib_filter_rate, _lib_filter_max_bytes)
+        ret.database, ret.hash_scheme, ret.generation = _lib_filter_state()
+        if _persist_lib_filter():
+            bloom.write(bloom.filter_file, ret)
+    return ret
+
+
+def _cached_result(dex: Dex, detect: Callable[[Dex], Any]) -> Any:
+    key = _result_key(dex, detect.__name__)
+    if key is None:
+        return detect(dex)
+    result = _result_cache.get(key)
+    if result is None:
+        result = detect(dex)
+        _result_cache.put(key, result)
+    return copy.copy(result)  # callers may modify the result
+
+def _result_key(dex: Dex, detect_name: str) -> Optional[Tuple]:
+    if _result_cache is None:
+        return None
+    signature = _result_cache.key(dex)
+    if signature is None:
+        return None
+    return (
+        detect_name,
+        signature,
+        *_lib_filter_state(),  # results of another database directory may share its generation
+        _thresholds.LibMatchRate,
+        _use_similarity and _thresholds.MinSimilarity
+    )
+
+
 def detect_apk_libraries(apk_file: Union[bytes, str]) -> List[PkgResult]:
     """Detect third-party libraries in an APK file
     This is a wrapper of `detect_dex_libraries`
     For performance consideration, only use this function if there is no other analyzers
     """
     ret: List[PkgResult] = [ ]
-    for dex in Apk(apk_file):
+    for dex in _apk_dexes(apk_file):
         ret += detect_dex_libraries(dex)
     return ret
 
@@ -94,17 +449,151 @@ def detect_exact_apk_libraries(apk_file: Union[bytes, str]) -> Dict[str, str]:
     For performance consideration, only use this function if there is no othre analyzers
     """
     ret = { }
-    for dex in Apk(apk_file):
+    for dex in _apk_dexes(apk_file):
         ret.update(detect_exact_dex_libraries(dex))
     return ret
 
 
+def detect_apk_libraries_batch(apk_files: Iterable[Union[bytes, str]], workers: Optional[int] = None) -> Iterator[BatchResult]:
+    """Detect third-party libraries in many APK files with a process pool
+    Yield a `BatchResult` for each APK as soon as it finishes, not in input order.
+    The `result` is the same as `detect_apk_libraries`; a failed APK has `result` None and
+    `error` set, and does not abort the batch.
+    `workers` defaults to the number of CPUs; 1 runs in current process.
+    """
+    return _run_batch(detect_apk_libraries, apk_files, workers)
+
+def detect_exact_apk_libraries_batch(apk_files: Iterable[Union[bytes, str]], workers: Optional[int] = None) -> Iterator[BatchResult]:
+    """Batch version of `detect_exact_apk_libraries`, see `detect_apk_libraries_batch`"""
+    return _run_batch(detect_exact_apk_libraries, apk_files, workers)
+
+def _run_batch(func: Callable, apk_files: Iterable[Union[bytes, str]], workers: Optional[int]) -> Iterator[BatchResult]:
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tasks = ( (func, apk_file) for apk_file in apk_files )
+
+    if workers <= 1:
+        for task in tasks:
+            yield _batch_worker(task)
+        return
+
+    # Forked workers inherit the loaded database, API set and whitelist copy-on-write,
+    # so nothing is reloaded or pickled per task; they are loaded lazily, so load them before forking
+    _load_shared_state()
+    import multiprocessing
+    try:
+        ctx = multiprocessing.get_context('fork')
+    except ValueError:
+        lx.warning('fork is unavailable, each worker will load its own database')
+        ctx = multiprocessing.get_context()
+    with ctx.Pool(workers) as pool:
+        yield from pool.imap_unordered(_batch_worker, tasks)
+
+def _load_shared_state() -> None:
+    """Load database, API vocabulary, whitelist, library filter and similarity index in current process"""
+    global _similarity_index
+    _db.match_libs([ ])
+    for name in [ 'hash_scheme', 'generation', 'lib_set', 'api_set', 'api_ids' ]:
+        getattr(_db, name, None)
+    _get_lib_filter()
+    if _use_similarity and _similarity_index is None:
+        _similarity_index = _build_similarity_index()
+
+def _batch_worker(task: Tuple[Callable, Union[bytes, str]]) -> BatchResult:
+    func, apk_file = task
+    try:
+        return BatchResult(apk_file, func(apk_file), None)
+    except Exception:
+        return BatchResult(apk_file, None, traceback.format_exc())
+
+
+async def detect_dex_libraries_async(dex: Dex) -> List[PkgResult]:
+    """Async version of `detect_dex_libraries`
+    The event loop runs other tasks, e.g. building trees of other dex files, during database lookup.
+    """
+    return await _cached_result_async(dex, _detect_dex_libraries_async, '_detect_dex_libraries')
+
+async def _detect_dex_libraries_async(dex: Dex) -> List[PkgResult]:
+    tree = _build_tree(dex, _use_similarity)
+    tree.set_db_match_result(await _match_libs_async(tree))
+    return _gen_results(tree, _tree_signatures(tree))
+
+async def detect_exact_dex_libraries_async(dex: Dex) -> Dict[str, str]:
+    """Async version of `detect_exact_dex_libraries`"""
+    return await _cached_result_async(dex, _detect_exact_dex_libraries_async, '_detect_exact_dex_libraries')
+
+async def _detect_exact_dex_libraries_async(dex: Dex) -> Dict[str, str]:
+    tree = _build_tree(dex)
+    tree.set_db_match_result(await _match_libs_async(tree))
+    return tree.detect_exact_libs()
+
+async def detect_apk_libraries_async(apk_file: Union[bytes, str]) -> List[PkgResult]:
+    """Async version of `detect_apk_libraries`
+    Tree of each dex file is built while earlier dex files are being looked up.
+    Many APKs can be processed concurrently, e.g. with `asyncio.gather`.
+    """
+    import asyncio
+    ret: List[PkgResult] = [ ]
+    for result in await asyncio.gather(*( detect_dex_libraries_async(dex) for dex in _apk_dexes(apk_file) )):
+        ret += result
+    return ret
+
+async def detect_exact_apk_libraries_async(apk_file: Union[bytes, str]) -> Dict[str, str]:
+    """Async version of `detect_exact_apk_libraries`, see `detect_apk_libraries_async`"""
+    import asyncio
+    ret = { }
+    for result in await asyncio.gather(*( detect_exact_dex_libraries_async(dex) for dex in _apk_dexes(apk_file) )):
+        ret.update(result)
+    return ret
+
+async def _cached_result_async(dex: Dex, detect: Callable[[Dex], Awaitable[Any]], detect_name: str) -> Any:
+    """See `_cached_result`; results are shared with the sync version named `detect_name`"""
+    key = _result_key(dex, detect_name)
+    if key is None:
+        return await detect(dex)
+    result = _result_cache.get(key)
+    if result is None:
+        result = await detect(dex)
+        _result_cache.put(key, result)
+    return copy.copy(result)
+
+async def _match_libs_async(tree: PackageTree) -> List[LibInfo]:
+    hashes = list(_filter_hashes(tree.nodes.keys()))
+    with stats.phase('db.match_libs'):  # wall time includes other tasks running meanwhile
+        libs = await _call_db('match_libs', hashes)
+    if stats.enabled:
+        stats.count('db.match_libs.hashes', len(hashes))
+        stats.count('db.match_libs.rows', len(libs))
+    return libs
+
+async def _call_db(name: str, *args: Any) -> Any:
+    """Call a database function from event loop, awaiting it if async, otherwise running it in database thread"""
+    import asyncio, concurrent.futures, inspect
+    global _db_executor
+    func = getattr(_db, name)
+    if inspect.iscoroutinefunction(func):
+        return await func(*args)
+    if _db_executor is None:
+        _db_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='library-db')
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, func, *args)
+
+
 def add_dex_to_database(dex: Dex) -> None:
     """Add packages in a dex file to database
     This will NOT modify the library database
     Call `update_library_database` later
     """
-    _db.add_pkgs(_get_pkgs(dex))
+    pkgs, signatures = _get_records(dex)
+    _db.add_pkgs(pkgs)
+    _add_signatures(signatures)
+
+def add_analysis_to_database(analysis: Analysis) -> None:
+    """Add packages of an analyzed dex file to database, see `add_dex_to_database`"""
+    hash_scheme = getattr(_db, 'hash_scheme', 1)
+    if analysis.hash_scheme != hash_scheme:
+        raise ValueError('Analysis uses hash scheme %d but database uses %d' % (analysis.hash_scheme, hash_scheme))
+    _db.add_pkgs(analysis.pkgs)
+    _add_signatures(analysis.signatures)
 
 def remove_dex_from_database(dex: Dex) -> None:
     """Remove packages in a dex file from database
@@ -115,29 +604,203 @@ def remove_dex_from_database(dex: Dex) -> None:
     _db.remove_pkgs(_get_pkgs(dex))
 
 def add_apk_to_database(apk_file: Union[str, bytes]) -> None:
-    """Wrapper of `add_dex_to_database`"""
-    for dex in Apk(apk_file):
-        _db.add_pkgs(_get_pkgs(dex))
+    """Wrapper of `add_dex_to_database`
+    Packages of all dex files are written to database at once
+    """
+    pkgs: List[PkgInfo] = [ ]
+    signatures: Dict[bytes, bytes] = { }
+    for dex in _apk_dexes(apk_file):
+        dex_pkgs, dex_signatures = _get_records(dex)
+        pkgs += dex_pkgs
+        signatures.update(dex_signatures)
+    _db.add_pkgs(pkgs)
+    _add_signatures(signatures)
 
 def remove_apk_from_database(apk_file: Union[str, bytes]) -> None:
-    """Wrapper of `remove_dex_from_database`"""
-    for dex in Apk(apk_file):
-        _db.remove_pkgs(_get_pkgs(dex))
+    """Wrapper of `remove_dex_from_database`
+    Packages of all dex files are written to database at once
+    """
+    pkgs: List[PkgInfo] = [ ]
+    for dex in _apk_dexes(apk_file):
+        pkgs += _get_pkgs(dex)
+    _db.remove_pkgs(pkgs)
+
+async def add_dex_to_database_async(dex: Dex) -> None:
+    """Async version of `add_dex_to_database`"""
+    pkgs, signatures = _get_records(dex)
+    await _call_db('add_pkgs', pkgs)
+    await _add_signatures_async(signatures)
+
+async def add_apk_to_database_async(apk_file: Union[str, bytes]) -> None:
+    """Async version of `add_apk_to_database`"""
+    pkgs: List[PkgInfo] = [ ]
+    signatures: Dict[bytes, bytes] = { }
+    for dex in _apk_dexes(apk_file):
+        dex_pkgs, dex_signatures = _get_records(dex)
+        pkgs += dex_pkgs
+        signatures.update(dex_signatures)
+    await _call_db('add_pkgs', pkgs)
+    await _add_signatures_async(signatures)
+
+async def _add_signatures_async(signatures: Dict[bytes, bytes]) -> None:
+    if len(signatures) > 0 and hasattr(_db, 'add_signatures'):
+        await _call_db('add_signatures', signatures)
+
+def add_apks_to_database(
+        apk_files: Iterable[Union[str, bytes]],
+        workers: Optional[int] = None,
+        checkpoint: Optional[str] = None,
+        flush_size: int = 1000) -> List[BatchResult]:
+    """Add packages of many APK files to database, extracting packages with a process pool
+    Package counts are aggregated in memory and written every `flush_size` APKs.
+    If `checkpoint` is given, digests of APKs written to database are appended to that file,
+    and APKs already listed there are skipped, so an interrupted run can simply be restarted.
+    In-memory database is dumped before each checkpoint update.
+    Return failed APKs; they are not checkpointed and will be retried by next run.
+    """
+    global _ingested
+    _ingested = set()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            _ingested = { line.strip() for line in f if line.strip() }
+
+    failures = [ ]
+    counts: Dict[Tuple[bytes, str, int], int] = defaultdict(int)
+    signatures: Dict[bytes, bytes] = { }
+    digests: List[str] = [ ]
+
+    for result in _run_batch(_extract_apk_pkgs, apk_files, workers):
+        if result.error is not None:
+            lx.warning('Failed to add %s to database' % result.apk)
+            failures.append(result)
+            continue
+        digest, pkgs, apk_signatures = result.result
+        if pkgs is None: continue  # finished by previous run
+
+        for pkg in pkgs:
+            counts[pkg] += 1
+        signatures.update(apk_signatures)
+        digests.append(digest)
+        if len(digests) >= flush_size:
+            _flush_ingested(counts, signatures, digests, checkpoint)
+
+    _flush_ingested(counts, signatures, digests, checkpoint)
+    return failures
+
+def _extract_apk_pkgs(apk_file: Union[str, bytes]) -> Tuple[str, Optional[List[PkgInfo]], Dict[bytes, bytes]]:
+    digest = hashlib.sha1()
+    if isinstance(apk_file, bytes):
+        digest.update(apk_file)
+    else:
+        with open(apk_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    if digest.hexdigest() in _ingested:
+        return digest.hexdigest(), None, { }
+
+    pkgs: List[PkgInfo] = [ ]
+    signatures: Dict[bytes, bytes] = { }
+    for dex in _apk_dexes(apk_file):
+        dex_pkgs, dex_signatures = _get_records(dex)
+        pkgs += dex_pkgs
+        signatures.update(dex_signatures)
+    return digest.hexdigest(), pkgs, signatures
+
+def _flush_ingested(counts: Dict[Tuple[bytes, str, int], int], signatures: Dict[bytes, bytes],
+        digests: List[str], checkpoint: Optional[str]) -> None:
+    if len(digests) == 0: return
+
+    rows = [ (PkgInfo._make(pkg), count) for pkg, count in counts.items() ]
+    if hasattr(_db, 'add_pkg_counts'):
+        _db.add_pkg_counts(rows)
+    else:
+        _db.add_pkgs([ pkg for pkg, count in rows for _ in range(count) ])
+    _add_signatures(signatures)
+
+    if checkpoint is not None:
+        if not getattr(_db, 'durable', True):
+            _db.dump()
+        # an APK is only recorded after its packages are persisted, so it is never added twice
+        # unless the process is killed between these two writes
+        with open(checkpoint, 'a') as f:
+            f.write(''.join( digest + '\n' for digest in digests ))
+            f.flush()
+            os.fsync(f.fileno())
+
+    lx.info('%d APKs added to database' % len(digests))
+    counts.clear()
+    signatures.clear()
+    digests.clear()
+
+
+class _ApkDex:
+    """All dex files of an APK as one dex; a class in several dex files is taken from the first one, like Android"""
+
+    def __init__(self, dexes: List[Dex]) -> None:
+        self._dexes = dexes
+        self.classes: List[DexClass] = [ ]
+        names: Set[str] = set()
+        for dex in dexes:
+            for class_ in dex.classes:
+                name = class_.name()
+                if name not in names:
+                    names.add(name)
+                    self.classes.append(class_)
+
+    def signature(self) -> Optional[bytes]:
+        ret = hashlib.sha1()
+        for dex in self._dexes:
+            signature = dex_signature(dex)
+            if signature is None:
+                return None
+            ret.update(signature)
+        return ret.digest()
+
+def _apk_dexes(apk_file: Union[bytes, str]) -> Iterable[Dex]:
+    """Dex files of an APK, or one dex of all of them if APK tree is enabled"""
+    if _apk_tree:
+        return [ cast(Dex, _ApkDex(list(Apk(apk_file)))) ]
+    return Apk(apk_file)
+
+
+def _build_tree(dex: Dex, collect_apis: bool = False) -> PackageTree:
+    """`collect_apis` records APIs of packages for similarity signatures, see `PackageTree`"""
+    hash_scheme = getattr(_db, 'hash_scheme', 1)
+    if hash_scheme == 1:
+        return _tree_class(dex, _db.api_set, 1, collect_apis)
+    else:
+        return _tree_class(dex, _db.api_ids, hash_scheme, collect_apis)
 
 def _get_pkgs(dex: Dex) -> List[PkgInfo]:
-    tree = PackageTree(dex, _db.api_set)
+    tree = _build_tree(dex)
     pkgs = [ ]
-    for node in tree.nodes.values():
-        if cast(int, node.weight) < _thresholds.MinApiWeight: continue
-        if len(node.name) <= 2: continue  # 'L' + single letter
-        if node.name in _thresholds.PkgNameBlackList: continue
-        pkgs.append(node)
-    return cast(List[PkgInfo], pkgs)
+    for pkg in tree.pkgs():
+        if _is_recordable(pkg):
+            pkgs.append(pkg)
+    return pkgs
+
+def _is_recordable(pkg: PkgInfo) -> bool:
+    if pkg.weight < _thresholds.MinApiWeight: return False
+    if len(pkg.name) <= 2: return False  # 'L' + single letter
+    if pkg.name in _thresholds.PkgNameBlackList: return False
+    return True
 
 
-def update_library_database() -> None:
-    """Filter the package database to update the library database"""
-    filterlibs.main(_thresholds, _db)
+def update_library_database(incremental: bool = False) -> None:
+    """Filter the package database to update the library database
+    By default all packages are processed, and libraries are only added.
+    If `incremental` is true, only packages added or removed since last incremental update
+    are processed, and libraries no longer qualified are removed.
+    """
+    global _similarity_index, _lib_filter
+    with stats.phase('filterlibs'):
+        filterlibs.main(_thresholds, _db, incremental)
+    if _use_similarity:
+        _similarity_index = _build_similarity_index()
+    if _use_lib_filter:
+        _lib_filter = _build_lib_filter()
+    if _result_cache is not None:
+        _result_cache.clear()  # entries are keyed on old database generation (if supported) and useless now
 
 
 def dump_database() -> None:
@@ -148,6 +811,9 @@ def dump_database() -> None:
 
 def load_database() -> None:
     """Load database from file system to memory
+    In-memory database is loaded automatically on first use, call this to reload it
     Not needed when using SQL database
     """
+    global _lib_filter
     _db.load()
+    _lib_filter = None
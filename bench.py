@@ -0,0 +1,714 @@
+"""Benchmarks
+
+Usage: python -m library.bench [--save-baseline] [name ...]
+Run all benchmarks if no name is given.
+
+Results are compared with bench_baseline.json, and slower or larger results fail.
+The stored baseline is machine-specific; run with --save-baseline to record the
+current results as baseline instead.
+"""
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+
+ImportRepeat = 5
+
+##  Cold import of the package, after its `common` dependency, should not be slower than this
+##  It takes about 0.02s; a heavy top-level import (asyncio alone takes 0.04s) exceeds the limit
+MaxImportSeconds = 0.05
+
+
+def bench_import() -> Dict[str, float]:
+    """Time a cold `import` of the package in fresh interpreters (best of several runs)
+    `common` is imported before timing: it is not part of this package, and much slower to import.
+    """
+    code = 'import common, time; t = time.perf_counter(); import %s; print(time.perf_counter() - t)' % __package__
+    return { 'import_seconds': min( _run_python(code) for _ in range(ImportRepeat) ) }
+
+
+def check_import(result: Dict[str, float]) -> List[str]:
+    if result['import_seconds'] > MaxImportSeconds:
+        return [ 'cold import took %.3fs, limit is %.3fs' % (result['import_seconds'], MaxImportSeconds) ]
+    return [ ]
+
+
+TrimGroupSizes = [ 10, 100, 1000, 10000 ]
+
+##  Larger groups are too slow for the original all-pairs algorithm
+MaxPairwiseGroupSize = 1000
+
+
+def bench_trim() -> Dict[str, float]:
+    """Time name trimming of synthetic hash groups, against the original all-pairs algorithm"""
+    from .filterlibs import _trim_names, _trim_names_pairwise
+
+    ret = { }
+    for size in TrimGroupSizes:
+        names = _synthetic_names(size, random.Random(size))
+
+        start = time.perf_counter()
+        result = list(_trim_names(names))
+        ret['trim_%d_seconds' % size] = time.perf_counter() - start
+
+        if size <= MaxPairwiseGroupSize:
+            start = time.perf_counter()
+            expected = list(_trim_names_pairwise(names))
+            ret['trim_pairwise_%d_seconds' % size] = time.perf_counter() - start
+            ret['trim_%d_mismatch' % size] = float(result != expected)
+    return ret
+
+def check_trim(result: Dict[str, float]) -> List[str]:
+    return [ '%s is wrong' % key[ : -len('_mismatch') ] for key, value in result.items() if key.endswith('_mismatch') and value ]
+
+def _synthetic_names(count: int, rng: random.Random) -> Set[str]:
+    """Names of one library as found in many apps: original, repackaged, partially and fully obfuscated"""
+    lib = [ 'com', 'squareup', 'okhttp3' ]
+    words = [ 'app', 'sdk', 'libs', 'thirdparty', 'shadow', 'internal', 'vendor' ]
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    names = { 'L' + '/'.join(lib) }
+    while len(names) < count:
+        kind = rng.random()
+        if kind < 0.4:  # repackaged under app prefix
+            prefix = [ rng.choice(words) + str(rng.randrange(count)) for _ in range(rng.randint(1, 3)) ]
+            parts = prefix + lib
+        elif kind < 0.6:  # partially obfuscated
+            parts = [ p if rng.random() < 0.5 else rng.choice(letters) for p in lib ]
+        elif kind < 0.8:  # repackaged and obfuscated
+            parts = [ rng.choice(letters) for _ in range(rng.randint(1, 3)) ] + lib[ rng.randint(0, 2) : ]
+        else:  # fully obfuscated
+            parts = [ rng.choice(letters) for _ in range(rng.randint(1, 5)) ]
+        names.add('L' + '/'.join(parts))
+    return names
+
+
+PkgsMemoryRows = [ 1000000, 10000000 ]
+
+
+def bench_pkgs_memory() -> Dict[str, float]:
+    """Memory per package row of memdb storage, against the original nested dicts
+    Each measurement runs in a fresh interpreter, so peak RSS only covers that storage.
+    """
+    ret = { }
+    for rows in PkgsMemoryRows:
+        for impl in [ 'dict', 'pkgstore' ]:
+            code = 'from %s import bench; print(bench._measure_pkgs_memory(%r, %d))' % (__package__, impl, rows)
+            ret['%s_%d_bytes_per_row' % (impl, rows)] = _run_python(code)
+    return ret
+
+def check_pkgs_memory(result: Dict[str, float]) -> List[str]:
+    ret = [ ]
+    for rows in PkgsMemoryRows:
+        dict_size = result['dict_%d_bytes_per_row' % rows]
+        store_size = result['pkgstore_%d_bytes_per_row' % rows]
+        if store_size >= dict_size:
+            ret.append('pkgstore uses %.0f bytes per row at %d rows, dicts use %.0f' % (store_size, rows, dict_size))
+    return ret
+
+def _measure_pkgs_memory(impl: str, rows: int) -> float:
+    import resource
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if impl == 'dict':
+        from collections import defaultdict
+        pkgs: Dict[bytes, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        weights: Dict[bytes, int] = { }
+        for hash_, name, weight in _synthetic_pkgs(rows):
+            pkgs[hash_][name] += 1
+            weights[hash_] = weight
+    else:
+        from .pkgstore import PkgStore
+        store = PkgStore()
+        for hash_, name, weight in _synthetic_pkgs(rows):
+            store.add(hash_, name, 1, weight)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (after - before) * 1024 / rows  # ru_maxrss is in KiB on Linux
+
+def _synthetic_pkgs(rows: int, start: int = 0) -> Iterator[Tuple[bytes, str, int]]:
+    """Distinct (hash, name, weight) rows, about 1.5 names per hash; every name is a new string as in memdb"""
+    for i in range(start, start + rows):
+        hash_ = hashlib.sha1((i * 2 // 3).to_bytes(8, 'little')).digest()
+        yield hash_, 'Lcom/vendor%d/sdk%d' % (i % 50000, i % 7), i % 1000
+
+
+##  (apps, libraries) of synthetic corpora
+PipelineScales = [ (50, 50), (200, 100), (800, 200) ]
+
+
+def bench_pipeline() -> Dict[str, float]:
+    """Time each stage of database building and detection on synthetic corpora (see synthdex.py)
+    Each scale runs twice in fresh interpreters: once for time, once for peak memory under tracemalloc.
+    """
+    ret = { }
+    for apps, libs in PipelineScales:
+        for trace in [ False, True ]:
+            code = 'import json; from %s import bench; print(json.dumps(bench._run_pipeline(%d, %d, %r)))' % (__package__, apps, libs, trace)
+            for key, value in _run_python(code).items():
+                ret['%d_%s' % (apps, key)] = value
+    return ret
+
+def _run_pipeline(apps: int, libs: int, trace: bool) -> Dict[str, float]:
+    from . import filterlibs, memdb, thresholds, vocab
+    from .pkgtree import PackageTree
+    from .synthdex import generate_corpus
+    import tempfile
+    import tracemalloc
+
+    os.chdir(tempfile.mkdtemp())  # memdb files
+    corpus = generate_corpus(apps, libs, seed=apps)
+    api_set = vocab.api_set()
+    whitelist = vocab.lib_set()
+
+    ret = { }
+    def run(stage: str, items: int, func: Callable[[], Any]) -> None:
+        if trace:
+            tracemalloc.start()
+            func()
+            ret[stage + '_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            func()
+            ret[stage + '_seconds'] = time.perf_counter() - start
+            ret[stage + '_per_second'] = items / ret[stage + '_seconds']
+
+    classes = sum( len(dex.classes) for dex in corpus )
+    trees: List[Any] = [ ]
+    run('build', classes, lambda: trees.extend( PackageTree(dex, api_set) for dex in corpus ))
+
+    pkgs = [ tree.pkgs() for tree in trees ]
+    rows = sum(map(len, pkgs))
+    run('add_pkgs', rows, lambda: [ memdb.add_pkgs(p) for p in pkgs ])
+    run('filterlibs', rows, lambda: filterlibs.main(thresholds, memdb))
+    run('dump', rows, memdb.dump)
+    run('load', rows, memdb.load)
+
+    libs_of: List[Any] = [ ]
+    run('match_libs', apps, lambda: libs_of.extend( memdb.match_libs(tree.nodes.keys()) for tree in trees ))
+    run('set_db_match_result', apps, lambda: [ tree.set_db_match_result(l) for tree, l in zip(trees, libs_of) ])
+    run('detect_libs', apps, lambda: [ tree.detect_libs(thresholds.LibMatchRate, whitelist) for tree in trees ])
+
+    # `detect_libs` changed match results, so exact detection needs new trees
+    trees = [ PackageTree(dex, api_set) for dex in corpus ]
+    for tree, l in zip(trees, libs_of):
+        tree.set_db_match_result(l)
+    run('detect_exact_libs', apps, lambda: [ tree.detect_exact_libs() for tree in trees ])
+    return ret
+
+
+##  Synthetic round trip time of database lookups
+AsyncLatencySeconds = 0.01
+AsyncApps = 100
+
+
+def bench_async() -> Dict[str, float]:
+    """Detect libraries of synthetic apps with a database with injected lookup latency,
+    sequentially and with async API (synchronous database in a thread, and async database)
+    """
+    code = 'import json; from %s import bench; print(json.dumps(bench._run_async()))' % __package__
+    return _run_python(code)
+
+def check_async(result: Dict[str, float]) -> List[str]:
+    ret = [ ]
+    for mode in [ 'thread', 'async' ]:
+        if result[mode + '_mismatch']:
+            ret.append('%s results differ from sequential results' % mode)
+        if result[mode + '_seconds'] >= result['sequential_seconds']:
+            ret.append('%s detection is not faster than sequential detection' % mode)
+    return ret
+
+class _LatencyDb:
+    """Stand-in for a remote database: memdb with latency added to each lookup"""
+
+    def __init__(self, db: Any) -> None:
+        self._db = db
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._db, name)
+
+    def match_libs(self, hash_list: Iterable[bytes]) -> Any:
+        time.sleep(AsyncLatencySeconds)
+        return self._db.match_libs(hash_list)
+
+class _AsyncLatencyDb(_LatencyDb):
+    async def match_libs(self, hash_list: Iterable[bytes]) -> Any:
+        await asyncio.sleep(AsyncLatencySeconds)
+        return self._db.match_libs(hash_list)
+
+def _run_async() -> Dict[str, float]:
+    from . import memdb, thresholds, set_database, update_library_database, add_dex_to_database
+    from . import detect_dex_libraries, detect_dex_libraries_async
+    from .synthdex import generate_corpus
+    import tempfile
+
+    os.chdir(tempfile.mkdtemp())  # memdb files
+    corpus = generate_corpus(AsyncApps, AsyncApps // 2, seed=AsyncApps)
+    thresholds.MinLibCount = 3
+    for dex in corpus:
+        add_dex_to_database(dex)
+    update_library_database()
+
+    async def detect_all() -> List[Any]:
+        return await asyncio.gather(*( detect_dex_libraries_async(dex) for dex in corpus ))
+
+    ret = { }
+    set_database(_LatencyDb(memdb))
+    start = time.perf_counter()
+    expected = [ detect_dex_libraries(dex) for dex in corpus ]
+    ret['sequential_seconds'] = time.perf_counter() - start
+
+    for mode, db in [ ('thread', _LatencyDb(memdb)), ('async', _AsyncLatencyDb(memdb)) ]:
+        set_database(db)
+        start = time.perf_counter()
+        result = asyncio.run(detect_all())
+        ret[mode + '_seconds'] = time.perf_counter() - start
+        ret[mode + '_mismatch'] = float(result != expected)
+    return ret
+
+
+##  Configured false positive rate of library filter
+LibFilterRate = 0.01
+LibFilterApps = 200
+
+
+def bench_lib_filter() -> Dict[str, float]:
+    """Detect libraries of synthetic apps with and without library filter, counting hashes sent to database"""
+    code = 'import json; from %s import bench; print(json.dumps(bench._run_lib_filter()))' % __package__
+    return _run_python(code)
+
+def check_lib_filter(result: Dict[str, float]) -> List[str]:
+    ret = [ ]
+    if result['mismatch']:
+        ret.append('results with library filter differ from results without it')
+    if result['false_positive_rate'] > 2 * LibFilterRate:
+        ret.append('false positive rate %.4f is much higher than configured %.4f' % (result['false_positive_rate'], LibFilterRate))
+    return ret
+
+class _CountingDb(_LatencyDb):
+    """memdb counting looked up hashes, without latency"""
+
+    hashes = 0
+
+    def match_libs(self, hash_list: Iterable[bytes]) -> Any:
+        hash_list = list(hash_list)
+        self.hashes += len(hash_list)
+        return self._db.match_libs(hash_list)
+
+def _run_lib_filter() -> Dict[str, float]:
+    from . import memdb, thresholds, set_database, update_library_database, add_dex_to_database
+    from . import detect_dex_libraries, enable_lib_filter, get_stats, _build_tree, _get_lib_filter
+    from .synthdex import generate_corpus
+    import tempfile
+
+    os.chdir(tempfile.mkdtemp())  # memdb and filter files
+    corpus = generate_corpus(LibFilterApps, LibFilterApps // 2, seed=LibFilterApps)
+    thresholds.MinLibCount = 3
+    db = _CountingDb(memdb)
+    set_database(db)
+    for dex in corpus:
+        add_dex_to_database(dex)
+    update_library_database()
+    lib_hashes = set(memdb.get_lib_hashes())
+
+    start = time.perf_counter()
+    expected = [ detect_dex_libraries(dex) for dex in corpus ]
+    ret = { 'seconds': time.perf_counter() - start, 'hashes': float(db.hashes) }
+
+    enable_lib_filter(True, LibFilterRate)
+    update_library_database()  # builds the filter
+    db.hashes = 0
+    start = time.perf_counter()
+    result = [ detect_dex_libraries(dex) for dex in corpus ]
+    ret['filter_seconds'] = time.perf_counter() - start
+    ret['filter_hashes'] = float(db.hashes)
+    ret['mismatch'] = float(result != expected)
+
+    lib_filter = get_stats()['lib_filter']
+    ret['filter_bytes'] = float(lib_filter['bytes'])
+    ret['expected_false_positive_rate'] = lib_filter['false_positive_rate']
+    others = set()
+    for dex in corpus:
+        others.update(_build_tree(dex).nodes)
+    others -= lib_hashes
+    ret['false_positive_rate'] = len(_get_lib_filter().filter(others)) / max(len(others), 1)  # type: ignore
+    return ret
+
+
+SqliteApps = 400
+
+
+def bench_sqlite() -> Dict[str, float]:
+    """Ingest synthetic apps, update libraries and look up all package hashes, with memdb and sqlitedb"""
+    code = 'import json; from %s import bench; print(json.dumps(bench._run_sqlite()))' % __package__
+    return _run_python(code)
+
+def check_sqlite(result: Dict[str, float]) -> List[str]:
+    if result['mismatch']:
+        return [ 'sqlitedb lookup results differ from memdb' ]
+    return [ ]
+
+def _run_sqlite() -> Dict[str, float]:
+    from . import filterlibs, memdb, sqlitedb, thresholds, vocab
+    from .pkgtree import PackageTree
+    from .synthdex import generate_corpus
+    import tempfile
+
+    os.chdir(tempfile.mkdtemp())  # database files
+    corpus = generate_corpus(SqliteApps, SqliteApps // 2, seed=SqliteApps)
+    thresholds.MinLibCount = 3
+    api_set = vocab.api_set()
+    trees = [ PackageTree(dex, api_set) for dex in corpus ]
+    pkgs = [ tree.pkgs() for tree in trees ]
+    rows = sum(map(len, pkgs))
+    hashes = sum( len(tree.nodes) for tree in trees )
+
+    ret = { 'rows': float(rows) }
+    results = [ ]
+    for name, db in [ ('memdb', memdb), ('sqlitedb', sqlitedb) ]:
+        start = time.perf_counter()
+        for p in pkgs:
+            db.add_pkgs(p)
+        ret[name + '_add_pkgs_per_second'] = rows / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        filterlibs.main(thresholds, db)
+        ret[name + '_filterlibs_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results.append([ sorted(db.match_libs(tree.nodes.keys())) for tree in trees ])
+        ret[name + '_match_libs_per_second'] = hashes / (time.perf_counter() - start)
+    ret['sqlitedb_file_mb'] = os.path.getsize(sqlitedb.database_file) / 2 ** 20
+    ret['mismatch'] = float(results[0] != results[1])
+    return ret
+
+
+##  Chunk size of sqldb lookups in its check, small so that lookups span several chunks
+SqldbChunkSize = 7
+SqldbPageSize = 5
+
+##  Tables of an OrangeAPK MySQL database before sqldb migrations
+_SqldbOldSchema = [
+    'create table packages (hash blob not null, pkg_name text not null, weight integer not null, ' +
+        'count integer not null, primary key (hash, pkg_name))',
+    'create table libraries (hash blob not null, pkg_name text not null, primary key (hash, pkg_name))',
+]
+
+
+def bench_sqldb() -> Dict[str, float]:
+    """Check sqldb against SQLite standing in for MySQL: migration, chunked and cached lookups,
+    generations, removed libraries and paging
+    """
+    code = 'import json; from %s import bench; print(json.dumps(bench._run_sqldb()))' % __package__
+    return _run_python(code)
+
+def check_sqldb(result: Dict[str, float]) -> List[str]:
+    return [ 'sqldb %s is wrong' % key[ : -len('_mismatch') ] for key, value in result.items() if key.endswith('_mismatch') and value ]
+
+class _SqliteLx:
+    """Stand-in for `lx` in sqldb, running its MySQL statements on an in-memory SQLite database
+    Only the syntax sqldb uses is translated. Other attributes are those of the real `lx`.
+    """
+
+    _Dialect = [
+        (r'information_schema\.tables where table_schema = database\(\)', "sqlite_master where type = 'table'"),
+        (r'select table_name from sqlite_master', 'select name from sqlite_master'),
+        (r'select column_name from information_schema\.columns where table_schema = database\(\) and table_name = \?',
+            'select name from pragma_table_info(?)'),
+        (r'select index_name, column_name from information_schema\.statistics where table_schema = database\(\) ' +
+            r'and table_name = \? order by index_name, seq_in_index',
+            'select il.name, ii.name from pragma_index_list(?) il, pragma_index_info(il.name) ii order by il.name, ii.seqno'),
+        (r'on duplicate key update', 'on conflict do update set'),
+        (r'values\((\w+)\)', r'excluded.\1'),
+        (r'\bif\(', 'iif('),
+        (r'insert ignore', 'insert or ignore'),
+    ]
+
+    def __init__(self, lx: Any, schema: List[str]) -> None:
+        import sqlite3
+        self._lx = lx
+        self.conn = sqlite3.connect(':memory:')
+        for sql in schema:
+            self.conn.execute(sql)
+        self.queries = 0
+        self.commits = 0
+        self._last_insert_id = 0
+        self.conn.create_function('last_insert_id', -1, self._last_insert_id_function)
+
+    def _last_insert_id_function(self, *value: int) -> int:
+        """MySQL `last_insert_id(expr)` sets the value returned by later `last_insert_id()`"""
+        if len(value) > 0:
+            self._last_insert_id = value[0]
+        return self._last_insert_id
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._lx, name)
+
+    def _translate(self, sql: str, args: Tuple) -> Tuple[str, List[Any]]:
+        import re
+        if '{ARGS}' in sql:  # last argument is a list of values
+            values = list(args[-1])
+            sql = sql.replace('{ARGS}', '(%s)' % ','.join([ '%s' ] * len(values)))
+            args = args[ : -1 ] + tuple(values)
+        sql = sql.replace('%s', '?')
+        for pattern, repl in self._Dialect:
+            sql = re.sub(pattern, repl, sql)
+        return sql, list(args)
+
+    def query(self, db: str, sql: str, *args: Any) -> List[Any]:
+        sql, values = self._translate(sql, args)
+        self.queries += 1
+        with self.conn:
+            return self.conn.execute(sql, values).fetchall()
+
+    def commit_multi(self, db: str, sql: str, rows: List[Any]) -> None:
+        sql, _ = self._translate(sql, ())
+        self.commits += 1
+        with self.conn:
+            self.conn.executemany(sql, rows)
+
+def _run_sqldb() -> Dict[str, float]:
+    from . import sqldb
+    from .stub import LibInfo, PkgInfo
+
+    fake = _SqliteLx(sqldb.lx, _SqldbOldSchema)
+    sqldb.lx = fake
+    sqldb.QueryChunkSize = SqldbChunkSize
+    sqldb.GetPkgsPageSize = SqldbPageSize
+    sqldb.WriteChunkSize = SqldbChunkSize
+    hashes = [ hashlib.sha1(b'%d' % i).digest() for i in range(60) ]
+    ret = { }
+
+    # a database created before the migrated tables and columns, which are created on first use
+    fake.conn.execute('insert into libraries values (?, ?)', (hashes[0], 'Lold'))
+    ret['migration_mismatch'] = float(sqldb.hash_scheme != 1 or sqldb.match_libs(hashes[ : 1 ]) != [ LibInfo(hashes[0], 'Lold') ])
+    sqldb._migrated = False
+    queries = fake.queries
+    sqldb.migrate()  # again, only reading the schema
+    ret['migration_rerun_mismatch'] = float(fake.queries - queries != 2 + len(sqldb._Columns) + len(sqldb._Indexes))
+
+    # lookups across chunk boundaries; most hashes are not libraries
+    sqldb.remove_libs([ LibInfo(hashes[0], 'Lold') ])
+    libs = [ LibInfo(hashes[i], 'Llib%d' % i) for i in [ 0, 6, 7, 13, 14, 20, 21, 27, 28 ] ]
+    commits = fake.commits
+    sqldb.add_libs(libs)
+    mismatch = False
+    for size in [ 1, 6, 7, 8, 14, 15, 29 ]:
+        sqldb._lookup_cache.clear()
+        queries = fake.queries
+        result = sqldb.match_libs(hashes[ : size ])
+        expected_queries = (size + SqldbChunkSize - 1) // SqldbChunkSize
+        mismatch |= sorted(result) != sorted( lib for lib in libs if lib.hash in hashes[ : size ] )
+        mismatch |= fake.queries - queries != expected_queries
+    ret['chunks_mismatch'] = float(mismatch)
+
+    # each call writes a new generation in one transaction, though it has more rows than a write chunk
+    generations = fake.conn.execute('select generation from libraries where pkg_name like ? order by hash', ('Llib%',)).fetchall()
+    ret['generation_mismatch'] = float(fake.commits - commits != 1 or set(generations) != { (sqldb.generation,) } or
+            fake.conn.execute("select value from meta where name = 'generation'").fetchall() != [ (sqldb.generation,) ])
+
+    # all hashes are cached, including those which are not libraries
+    queries = fake.queries
+    result = sqldb.match_libs(hashes[ : 29 ])
+    ret['cached_lookup_queries'] = float(fake.queries - queries)
+    ret['cache_mismatch'] = float(fake.queries != queries or sorted(result) != sorted(libs))
+
+    # new library of a hash cached as not library
+    sqldb.add_libs([ LibInfo(hashes[1], 'Lnew') ])
+    ret['add_libs_cache_mismatch'] = float(sqldb.match_libs(hashes[ 1 : 2 ]) != [ LibInfo(hashes[1], 'Lnew') ])
+
+    # libraries changed by another process are only seen after refresh
+    generation = sqldb.generation
+    sqldb.match_libs(hashes[ 2 : 3 ])  # cached as not library
+    with fake.conn:  # taking a generation as sqldb does
+        fake.conn.execute("update meta set value = value + 1 where name = 'generation'")
+        fake.conn.execute('insert into libraries (hash, pkg_name, generation, removed) values (?, ?, ?, 0)', (hashes[2], 'Lother', generation + 1))
+    stale = sqldb.match_libs(hashes[ 2 : 3 ]) == [ ]
+    sqldb.refresh()
+    ret['refresh_mismatch'] = float(not stale or sqldb.generation != generation + 1 or
+            sqldb.match_libs(hashes[ 2 : 3 ]) != [ LibInfo(hashes[2], 'Lother') ])
+
+    # preloaded libraries follow removals and additions by refresh
+    sqldb.preload()
+    sqldb.remove_libs([ LibInfo(hashes[1], 'Lnew') ])
+    sqldb.add_libs([ LibInfo(hashes[3], 'Lpreload') ])
+    expected = sorted(libs + [ LibInfo(hashes[2], 'Lother'), LibInfo(hashes[3], 'Lpreload') ])
+    ret['preload_mismatch'] = float(sorted(sqldb.match_libs(hashes)) != expected or
+            sorted(sqldb.get_lib_hashes()) != sorted({ lib.hash for lib in expected }))
+
+    # packages paged by (hash, name), with several names per hash across page boundaries
+    pkgs = [ PkgInfo(hashes[i // 3], 'Lpkg%d' % (i % 3), i) for i in range(40) ]
+    sqldb.add_pkg_counts([ (pkg, 1 + i % 4) for i, pkg in enumerate(pkgs) ])
+    expected_pkgs = sorted( (pkg.hash, pkg.name) for i, pkg in enumerate(pkgs) if 1 + i % 4 >= 2 )
+    ret['paging_mismatch'] = float([ (pkg.hash, pkg.name) for pkg in sqldb.get_pkgs(2) ] != expected_pkgs)
+    ret['changed_mismatch'] = float(sqldb.get_changed_hashes() != { pkg.hash for pkg in pkgs })
+    return ret
+
+
+##  Package rows of count index benchmark; every `ChurnCommonEvery`-th row is common, appearing
+##  `ChurnCommonCount` times, the others once
+ChurnRows = 300000
+ChurnCommonEvery = 20
+ChurnCommonCount = 50
+ChurnThreshold = 10
+ChurnVersions = 8
+##  Rounds of apps whose package names are unique to the app, and their package rows
+ChurnNameRounds = 20
+ChurnNameRows = 10000
+
+
+def bench_pkgs_churn() -> Dict[str, float]:
+    """`get_pkgs` threshold query through count index against a scan of all rows, and rows and names
+    allocated while versions of synthetic apps are added and the previous version removed
+    """
+    from .pkgstore import PkgStore
+    store = PkgStore()
+    for i, (hash_, name, weight) in enumerate(_synthetic_pkgs(ChurnRows)):
+        store.add(hash_, name, ChurnCommonCount if i % ChurnCommonEvery == 0 else 1, weight)
+
+    start = time.perf_counter()
+    indexed = list(store.at_least(ChurnThreshold))
+    ret = { 'index_seconds': time.perf_counter() - start }
+    start = time.perf_counter()
+    scanned = [ ]
+    for hash_ in sorted(store):
+        weight = store.weight(hash_)
+        scanned += ( (hash_, name, weight) for name, count in store.counts(hash_) if count >= ChurnThreshold )
+    ret['scan_seconds'] = time.perf_counter() - start
+    ret['mismatch'] = float(indexed != scanned)
+
+    store.clear()
+    version_rows = ChurnRows // ChurnVersions
+    for version in range(ChurnVersions):
+        for hash_, name, weight in _synthetic_pkgs(version_rows, version * version_rows):
+            store.add(hash_, name, 1, weight)
+        if version > 0:
+            for hash_, name, weight in _synthetic_pkgs(version_rows, (version - 1) * version_rows):
+                store.add(hash_, name, -1)
+    ret['churn_live_rows'] = float(sum( 1 for _ in store.items() ))
+    ret['churn_allocated_rows'] = float(len(store._row_name))
+
+    # obfuscated and app-specific names are never seen again once their app is removed
+    store.clear()
+    for round_ in range(ChurnNameRounds + 1):
+        if round_ < ChurnNameRounds:
+            for hash_, name, weight in _synthetic_pkgs(ChurnNameRows, round_ * ChurnNameRows):
+                store.add(hash_, '%s/app%d' % (name, round_), 1, weight)
+        if round_ > 0:
+            for hash_, name, weight in _synthetic_pkgs(ChurnNameRows, (round_ - 1) * ChurnNameRows):
+                store.add(hash_, '%s/app%d' % (name, round_ - 1), -1)
+        if round_ == ChurnNameRounds - 1:
+            ret['churn_live_names'] = float(len({ name for _, name, _ in store.items() }))
+    ret['churn_allocated_names'] = float(len(store._names))
+    ret['churn_interned_names'] = float(len(store._name_ids))
+    return ret
+
+def check_pkgs_churn(result: Dict[str, float]) -> List[str]:
+    ret = [ ]
+    if result['mismatch']:
+        ret.append('count index results differ from scanning all rows')
+    # two versions are live before the older is removed; without reuse all versions stay allocated
+    if result['churn_allocated_rows'] > 2 * result['churn_live_rows']:
+        ret.append('%d rows allocated for %d live rows' % (result['churn_allocated_rows'], result['churn_live_rows']))
+    if result['churn_allocated_names'] > 2 * result['churn_live_names'] or result['churn_interned_names'] != 0:
+        ret.append('%d names allocated for %d live names' % (result['churn_allocated_names'], result['churn_live_names']))
+    return ret
+
+
+def _run_python(code: str) -> Any:
+    """Run `code` in a fresh interpreter which can import the package, return the JSON value it prints"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ root, os.environ.get('PYTHONPATH', '') ]))
+    out = subprocess.run([ sys.executable, '-c', code ], env=env, check=True, stdout=subprocess.PIPE)
+    return json.loads(out.stdout)
+
+
+Benchmarks: Dict[str, Callable[[], Dict[str, float]]] = {
+    'import': bench_import,
+    'trim': bench_trim,
+    'pkgs_memory': bench_pkgs_memory,
+    'pipeline': bench_pipeline,
+    'async': bench_async,
+    'lib_filter': bench_lib_filter,
+    'sqlite': bench_sqlite,
+    'pkgs_churn': bench_pkgs_churn,
+    'sqldb': bench_sqldb,
+}
+
+Checks: Dict[str, Callable[[Dict[str, float]], List[str]]] = {
+    'import': check_import,
+    'trim': check_trim,
+    'pkgs_memory': check_pkgs_memory,
+    'async': check_async,
+    'lib_filter': check_lib_filter,
+    'sqlite': check_sqlite,
+    'pkgs_churn': check_pkgs_churn,
+    'sqldb': check_sqldb,
+}
+
+
+BaselineFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+##  Results may be this much worse than baseline before they count as regressions
+MaxSlowdown = 1.5
+MaxMemoryGrowth = 1.2
+
+##  Shorter times are too noisy to compare
+MinBaselineSeconds = 0.05
+
+
+def check_baseline(name: str, result: Dict[str, float], baseline: Dict[str, float]) -> List[str]:
+    ret = [ ]
+    for key, value in result.items():
+        if key not in baseline: continue
+        if key.endswith('_seconds') and baseline[key] >= MinBaselineSeconds:
+            limit = baseline[key] * MaxSlowdown
+        elif key.endswith('_peak_mb'):
+            limit = baseline[key] * MaxMemoryGrowth
+        else:
+            continue
+        if value > limit:
+            ret.append('%s %s is %g, baseline is %g' % (name, key, value, baseline[key]))
+    return ret
+
+
+def main(args: List[str]) -> int:
+    save_baseline = '--save-baseline' in args
+    names = [ arg for arg in args if arg != '--save-baseline' ]
+
+    baseline: Dict[str, Dict[str, float]] = { }
+    if os.path.exists(BaselineFile):
+        with open(BaselineFile) as f:
+            baseline = json.load(f)
+
+    failures = [ ]
+    for name in (names or Benchmarks):
+        start = time.perf_counter()
+        result = Benchmarks[name]()
+        print('%s (%.1fs)' % (name, time.perf_counter() - start))
+        for key, value in result.items():
+            print('    %s: %g' % (key, value))
+        if name in Checks:
+            failures += Checks[name](result)
+        if save_baseline:
+            baseline[name] = result
+        else:
+            failures += check_baseline(name, result, baseline.get(name, { }))
+
+    if save_baseline:
+        with open(BaselineFile, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+    for failure in failures:
+        print('REGRESSION:', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
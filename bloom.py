@@ -0,0 +1,133 @@
+"""Bloom filter of library hashes
+
+Most package hashes of a dex file are app-specific and never match a library. Checking
+them against a filter of all library hashes first, only the few which may be libraries
+(all libraries, and a configurable rate of false positives) are looked up in database.
+
+Package hashes are SHA-1 or BLAKE2b digests, so bit positions are taken directly from
+their bytes (double hashing), without hashing again.
+
+File layout (little-endian):
+    header      magic, version, number of bit positions per hash, number of bits, count,
+                hash scheme, database generation, u16 size and UTF-8 database identity
+    bits        (number of bits + 7) / 8 bytes
+"""
+
+from common import *
+
+from typing import Iterator
+import math
+import os
+import struct
+
+
+Magic = b'LIBBLOOM'
+Version = 2
+_header = struct.Struct('<8sIIQQIQH')
+
+##  Maximal number of bit positions per hash, used when the filter is much larger than needed
+MaxPositions = 16
+
+filter_file = 'db_libfilter.bin'
+
+
+class BloomFilter:
+    def __init__(self, count: int, false_positive_rate: float = 0.01, max_bytes: Optional[int] = None) -> None:
+        """Empty filter sized for `count` hashes at given false positive rate, but at most `max_bytes`"""
+        count = max(count, 1)
+        bits = math.ceil(-count * math.log(false_positive_rate) / math.log(2) ** 2)
+        if max_bytes is not None:
+            bits = min(bits, max_bytes * 8)
+        self.bits = max(bits, 64)
+        self.positions = min(MaxPositions, max(1, round(self.bits / count * math.log(2))))
+        self.count = 0
+        self._bytes = bytearray((self.bits + 7) // 8)
+        # database and its state the filter was built from
+        self.database = ''
+        self.hash_scheme = 0
+        self.generation = 0
+
+    def __contains__(self, hash_: bytes) -> bool:
+        return all( self._bytes[i >> 3] >> (i & 7) & 1 for i in self._positions(hash_) )
+
+    def _positions(self, hash_: bytes) -> Iterator[int]:
+        h1 = int.from_bytes(hash_[ : 8 ], 'little')
+        h2 = int.from_bytes(hash_[ 8 : 16 ], 'little') | 1
+        for i in range(self.positions):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, hash_: bytes) -> None:
+        for i in self._positions(hash_):
+            self._bytes[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def filter(self, hashes: Iterable[bytes]) -> List[bytes]:
+        """Get hashes which may be in the filter; inlined version of `__contains__`"""
+        data = self._bytes
+        bits = self.bits
+        positions = range(self.positions)
+        ret = [ ]
+        for hash_ in hashes:
+            h1 = int.from_bytes(hash_[ : 8 ], 'little')
+            h2 = int.from_bytes(hash_[ 8 : 16 ], 'little') | 1
+            for i in positions:
+                bit = (h1 + i * h2) % bits
+                if not data[bit >> 3] >> (bit & 7) & 1:
+                    break
+            else:
+                ret.append(hash_)
+        return ret
+
+    def false_positive_rate(self) -> float:
+        """Expected false positive rate with current count"""
+        return (1 - math.exp(-self.positions * self.count / self.bits)) ** self.positions
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'bytes': len(self._bytes),
+            'positions': self.positions,
+            'false_positive_rate': self.false_positive_rate()
+        }
+
+
+def build(hashes: List[bytes], false_positive_rate: float, max_bytes: Optional[int] = None) -> BloomFilter:
+    ret = BloomFilter(len(hashes), false_positive_rate, max_bytes)
+    for hash_ in hashes:
+        ret.add(hash_)
+    return ret
+
+
+def write(path: str, bloom: BloomFilter) -> None:
+    """Write filter atomically (to a temporary file of this process which then replaces `path`)"""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        database = bloom.database.encode('utf8')
+        f.write(_header.pack(Magic, Version, bloom.positions, bloom.bits, bloom.count, bloom.hash_scheme, bloom.generation, len(database)))
+        f.write(database)
+        f.write(bloom._bytes)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read(path: str) -> BloomFilter:
+    with open(path, 'rb') as f:
+        header = f.read(_header.size)
+        if header[ : len(Magic) ] != Magic:
+            raise ValueError('%s is not a Bloom filter' % path)
+        if len(header) < _header.size or _header.unpack(header)[1] != Version:
+            raise ValueError('Unsupported Bloom filter version in %s' % path)
+        magic, version, positions, bits, count, hash_scheme, generation, size = _header.unpack(header)
+        database = str(f.read(size), 'utf8')
+        data = bytearray(f.read())
+    if len(data) != (bits + 7) // 8:
+        raise ValueError('%s is truncated' % path)
+    ret = BloomFilter.__new__(BloomFilter)
+    ret.positions = positions
+    ret.bits = bits
+    ret.count = count
+    ret.database = database
+    ret.hash_scheme = hash_scheme
+    ret.generation = generation
+    ret._bytes = data
+    return ret
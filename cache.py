@@ -0,0 +1,70 @@
+"""Bounded in-process caches, optionally persisted between runs"""
+
+from common import *
+
+from collections import OrderedDict
+import os
+import pickle
+
+
+class LruCache:
+    """Mapping bounded to `max_size` entries, evicting the least recently used ones"""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: Dict[Any, Any] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Any, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return { 'size': len(self._data), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses }
+
+    def save(self, path: str) -> None:
+        """Write entries to file atomically, least recently used first"""
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(list(self._data.items()), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path: str) -> None:
+        """Add entries saved by `save`; missing file is ignored"""
+        if not os.path.exists(path): return
+        with open(path, 'rb') as f:
+            for key, value in pickle.load(f):
+                self.put(key, value)
+
+
+class ResultCache(LruCache):
+    """Cache of detection results of whole dex files, keyed by dex signature and database state"""
+
+    def key(self, dex: Dex) -> Optional[bytes]:
+        return dex_signature(dex)
+
+
+def dex_signature(dex: Dex) -> Optional[bytes]:
+    """Get SHA-1 signature from dex header, or None if the dex parser does not expose it"""
+    signature = getattr(dex, 'signature', None)
+    if callable(signature):
+        signature = signature()
+    return signature
@@ -0,0 +1,131 @@
+"""Read-only database answering lookups from a library lookup server (see dbserver.py)
+
+Use with `set_database(clientdb)` in worker processes. Only the API vocabulary and
+whitelist are loaded in each process; the library database stays in the server.
+Packages cannot be added; build the database with memdb and serve its snapshot.
+"""
+
+from common import *
+
+from .stub import *
+from . import vocab
+from . import dbserver
+
+from contextlib import contextmanager
+from typing import Iterator
+import os
+import socket
+import threading
+
+
+api_set: Set[str]
+api_ids: Dict[str, int]
+lib_set: Set[str]
+hash_scheme: int
+generation: int
+
+def __getattr__(name: str) -> Any:
+    # these attributes are loaded on first access
+    if name == 'api_set': return vocab.api_set()
+    if name == 'api_ids': return vocab.api_ids()
+    if name == 'lib_set': return vocab.lib_set()
+    if name == 'hash_scheme':
+        if _hash_scheme is None: refresh()
+        return _hash_scheme
+    if name == 'generation':
+        if _generation is None: refresh()
+        return _generation
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+socket_path = dbserver.socket_path
+
+##  Maximal number of hashes in one request, and number of requests sent before reading responses
+##  Responses are small enough to fit in socket buffers, so client and server never block each other
+MatchChunkSize = 1000
+PipelineDepth = 4
+
+durable = True
+
+# connection of current process; forked workers open their own
+_sock: Optional[socket.socket] = None
+_sock_pid = 0
+_lock = threading.Lock()
+
+# server state seen by last request; generation is updated by every lookup
+_hash_scheme: Optional[int] = None
+_generation: Optional[int] = None
+
+
+def match_libs(hash_list: Iterable[bytes]) -> List[LibInfo]:
+    hashes = list(hash_list)
+    chunks = [ hashes[ i : i + MatchChunkSize ] for i in range(0, len(hashes), MatchChunkSize) ]
+    ret: List[LibInfo] = [ ]
+    with _lock, _connection() as sock:
+        for i, chunk in enumerate(chunks):
+            dbserver.send_frame(sock, b'M' + b''.join(chunk))
+            if i >= PipelineDepth - 1:
+                ret += _recv_match(sock, chunks[ i - PipelineDepth + 1 ])
+        for chunk in chunks[ max(len(chunks) - PipelineDepth + 1, 0) : ]:
+            ret += _recv_match(sock, chunk)
+    return ret
+
+def _recv_match(sock: socket.socket, hashes: List[bytes]) -> List[LibInfo]:
+    global _generation
+    _generation, libs = dbserver.parse_match(_recv(sock), hashes)
+    return libs
+
+def get_lib_hashes() -> Iterator[bytes]:
+    payload = _request(b'H')
+    for i in range(0, len(payload), dbserver.HashSize):
+        yield payload[ i : i + dbserver.HashSize ]
+
+
+def preload() -> None:
+    pass  # the server has the whole database in memory
+
+def refresh() -> None:
+    """Get hash scheme and generation of the database currently served"""
+    global _hash_scheme, _generation
+    _hash_scheme, _generation = dbserver.parse_info(_request(b'I'))
+
+def load() -> None:
+    """Make the server reload its snapshot file, e.g. after the database was rebuilt"""
+    global _hash_scheme, _generation
+    _hash_scheme, _generation = dbserver.parse_info(_request(b'R'))
+
+def dump() -> None:
+    lx.warning('Trying to dump database of lookup server')
+
+def add_pkgs(pkgs: List[PkgInfo]) -> None:
+    raise NotImplementedError('Lookup server is read-only')
+
+def remove_pkgs(pkgs: List[PkgInfo]) -> None:
+    raise NotImplementedError('Lookup server is read-only')
+
+
+def _request(payload: bytes) -> bytes:
+    with _lock, _connection() as sock:
+        dbserver.send_frame(sock, payload)
+        return _recv(sock)
+
+def _recv(sock: socket.socket) -> bytes:
+    payload = dbserver.recv_frame(sock)
+    if payload is None:
+        raise ConnectionError('Lookup server closed the connection')
+    return payload
+
+@contextmanager
+def _connection() -> Iterator[socket.socket]:
+    """Connect if not connected yet; after an error, responses may be pending, so reconnect on next request"""
+    global _sock, _sock_pid
+    if _sock is None or _sock_pid != os.getpid():
+        _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _sock.connect(socket_path)
+        _sock_pid = os.getpid()
+    try:
+        yield _sock
+    except BaseException:
+        _sock.close()
+        _sock = None
+        raise
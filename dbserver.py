@@ -0,0 +1,137 @@
+"""Library lookup server shared by worker processes on one machine
+
+The server memory-maps a database snapshot (see snapshot.py) once, and answers library
+lookups of clients (see clientdb.py) over a Unix socket, so workers do not load their
+own copy of the library database. Sending SIGHUP, or a reload request, opens the current
+snapshot file and swaps it in; lookups in progress finish with the old one.
+
+Usage: python -m library.dbserver [SNAPSHOT_FILE [SOCKET_PATH]]
+
+Protocol: each request and response is a frame of u32 length (little-endian) and payload.
+Clients may send several requests before reading responses; responses come in order.
+    b'M' + n x 20-byte hash     u64 generation, u32 count, count x (u32 hash index, u16 size, UTF-8 name)
+    b'I'                        u32 hash scheme, u64 generation
+    b'R'                        reload snapshot, then same as b'I'
+    b'H'                        distinct library hashes, 20 bytes each
+"""
+
+from common import *
+
+from .stub import *
+from .snapshot import HashSize
+from . import snapshot
+from . import memdb
+
+from typing import Tuple
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+
+
+socket_path = 'db_server.sock'
+
+_length = struct.Struct('<I')
+_info = struct.Struct('<IQ')
+_match_header = struct.Struct('<QI')
+_match_row = struct.Struct('<IH')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, snapshot_path: str, path: str) -> None:
+        self.snapshot_path = snapshot_path
+        self.index = snapshot.Snapshot(snapshot_path)
+        if os.path.exists(path):
+            os.remove(path)  # left by a killed server
+        super().__init__(path, _Handler)
+
+    def reload(self) -> None:
+        self.index = snapshot.Snapshot(self.snapshot_path)
+        lx.info('Reloaded %s, generation %d' % (self.snapshot_path, self.index.generation))
+
+    def handle_request_payload(self, payload: bytes) -> bytes:
+        index = self.index  # the same snapshot for whole request, even if reloaded meanwhile
+        command = payload[ : 1 ]
+        if command == b'M':
+            rows = [ ]
+            for i in range(0, (len(payload) - 1) // HashSize):
+                for name in index.match_libs(payload[ 1 + i * HashSize : 1 + (i + 1) * HashSize ]):
+                    data = name.encode('utf8')
+                    rows.append(_match_row.pack(i, len(data)) + data)
+            return _match_header.pack(index.generation, len(rows)) + b''.join(rows)
+        if command == b'R':
+            self.reload()
+            index = self.index
+        if command in (b'I', b'R'):
+            return _info.pack(index.hash_scheme, index.generation)
+        if command == b'H':
+            return b''.join(index.lib_hashes())
+        raise ValueError('Unknown request %r' % command)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        while True:
+            payload = recv_frame(self.request)
+            if payload is None: return
+            send_frame(self.request, cast(Server, self.server).handle_request_payload(payload))
+
+
+def send_frame(sock: socket.socket, payload: bytes) -> None:
+    sock.sendall(_length.pack(len(payload)) + payload)
+
+def recv_frame(sock: socket.socket) -> Optional[bytes]:
+    """Receive a frame, or return None if the connection is closed before it"""
+    header = _recv_exactly(sock, _length.size)
+    if header is None: return None
+    payload = _recv_exactly(sock, _length.unpack(header)[0])
+    if payload is None:
+        raise ConnectionError('Connection closed in the middle of a frame')
+    return payload
+
+def _recv_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            if len(buf) == 0: return None
+            raise ConnectionError('Connection closed in the middle of a frame')
+        buf += chunk
+    return bytes(buf)
+
+
+def parse_match(payload: bytes, hashes: List[bytes]) -> Tuple[int, List[LibInfo]]:
+    """Parse response of b'M' request for `hashes`, return generation and matched libraries"""
+    generation, count = _match_header.unpack_from(payload)
+    pos = _match_header.size
+    ret = [ ]
+    for _ in range(count):
+        i, size = _match_row.unpack_from(payload, pos)
+        pos += _match_row.size
+        ret.append(LibInfo(hashes[i], str(payload[ pos : pos + size ], 'utf8')))
+        pos += size
+    return generation, ret
+
+def parse_info(payload: bytes) -> Tuple[int, int]:
+    return _info.unpack(payload)
+
+
+def main(argv: List[str]) -> None:
+    snapshot_path = argv[0] if len(argv) > 0 else memdb.snapshot_file
+    path = argv[1] if len(argv) > 1 else socket_path
+    server = Server(snapshot_path, path)
+    signal.signal(signal.SIGHUP, lambda signum, frame: server.reload())
+    lx.info('Serving %s on %s' % (snapshot_path, path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,7 +1,18 @@
+from __future__ import annotations
+
 from common import *
 
 from .stub import *
 
+from collections.abc import Iterator
+from typing import Tuple
+import itertools
+import sys
+
+
+##  Number of libraries written to database at once by full update
+LibBatchSize = 10000
+
 
 def _name_better(n1: Optional[str], n2: Optional[str]) -> bool:
     """Check if package name `n1` is "better than" and able to replace `n2`"""
@@ -20,39 +31,167 @@ def _name_better(n1: Optional[str], n2: Optional[str]) -> bool:
     return True
 
 
-def main(thresholds, db):
-    lx.info('Loading packages database...')
+def _trim_names(names: Set[str]) -> Iterable[str]:
+    """Remove names which are "worse than" another name of the same package
+    Same result as `_trim_names_pairwise`, without comparing all pairs.
+
+    Each name is reduced to its `_name_better` key: reversed parts, where single-letter parts
+    become `None` (they match anything when the name is being replaced).
+    Names with identical keys are "better than" each other, and the last one in sorted order wins.
+    Key A is "better than" a different key B if A is a prefix of B, ignoring B's `None` parts;
+    this is found by searching a trie of all keys, instead of comparing each pair.
+    """
+    if len(names) <= 1: return names
+
+    keys = { name: _name_key(name) for name in names }
+
+    # obfuscated names are always worse than readable names
+    readable = [ name for name, (obfuscated, _) in keys.items() if not obfuscated ]
+    candidates = readable if len(readable) > 0 else list(names)
+
+    best_by_key: Dict[Tuple[Optional[str], ...], str] = { }
+    for name in sorted(candidates):
+        best_by_key[keys[name][1]] = name
+
+    trie = _KeyTrie(best_by_key.keys())
+    return sorted( name for key, name in best_by_key.items() if not trie.has_better(key) )
+
+def _name_key(name: str) -> Tuple[bool, Tuple[Optional[str], ...]]:
+    """Get obfuscation class and reversed parts of a name, as compared by `_name_better`"""
+    parts = list(reversed(name[1:-1].split('/')))
+    obfuscated = max(len(p) for p in parts) <= 1
+    return obfuscated, tuple( None if len(p) == 1 else p for p in parts )
+
+
+class _KeyTrie:
+    def __init__(self, keys: Iterable[Tuple[Optional[str], ...]]) -> None:
+        self.children: Dict[Optional[str], _KeyTrie] = { }
+        self.terminal = False
+        self.min_len = sys.maxsize  # length of shortest key in this subtree
+        for key in keys:
+            node = self
+            node.min_len = min(node.min_len, len(key))
+            for part in key:
+                node = node.children.setdefault(part, _KeyTrie(()))
+                node.min_len = min(node.min_len, len(key))
+            node.terminal = True
+
+    def has_better(self, key: Tuple[Optional[str], ...]) -> bool:
+        """Check if any other key in the trie is "better than" `key`"""
+        own = self._find(key)
+        stack = [ (self, 0) ]
+        while stack:
+            node, depth = stack.pop()
+            if node.terminal and node is not own:
+                return True
+            if depth == len(key): continue
+
+            if key[depth] is None:  # single-letter part matches anything
+                children: Iterable[_KeyTrie] = node.children.values()
+            elif key[depth] in node.children:
+                children = [ node.children[cast(str, key[depth])] ]
+            else:
+                children = [ ]
+
+            for child in children:
+                if child.min_len <= len(key):  # longer keys can never be better
+                    stack.append( (child, depth + 1) )
+        return False
+
+    def _find(self, key: Tuple[Optional[str], ...]) -> Optional[_KeyTrie]:
+        node: Optional[_KeyTrie] = self
+        for part in key:
+            node = cast(_KeyTrie, node).children.get(part)
+            if node is None: return None
+        return node
+
+
+def _trim_names_pairwise(names: Set[str]) -> Iterable[str]:
+    """Original O(n^2) implementation of `_trim_names`, kept as reference for benchmarks"""
+    if len(names) <= 1: return names
+    lst: List[Optional[str]] = list(sorted(names))
+    # if a name in the list is "worse than" another, set it to `None` and remove it later
+    for i in range(len(lst)):
+        for j in range(i):
+            if _name_better(lst[i], lst[j]):
+                lst[j] = None
+            elif _name_better(lst[j], lst[i]):
+                lst[i] = None
+    # remove names set to `None`
+    return [ n for n in lst if n is not None ]
 
-    names_by_hash: Dict[bytes, str] = defaultdict(set)
-    for pkg in db.get_pkgs(thresholds.MinLibCount):
-        names_by_hash[pkg.hash].add(pkg.name)
+
+def main(thresholds, db, incremental: bool = False):
+    if incremental:
+        _update(thresholds, db)
+        return
 
     lx.info('Trimming package names...')
     progress = 0
 
+    # packages are grouped by hash, so only one group and one batch of libraries are in memory
     libs: List[LibInfo] = [ ]
-    for hash_, names in names_by_hash.items():
-        if len(names) > 1:
-            names: List[Optinal[str]] = list(sorted(names))
-            # if a name in the list is "worse than" another, set it to `None` and remove it later
-            for i in range(len(names)):
-                for j in range(i):
-                    if _name_better(names[i], names[j]):
-                        names[j] = None
-                    elif _name_better(names[j], names[i]):
-                        names[i] = None
-            # remove names set to `None`
-            names = [ n for n in names if n is not None ]
-
-        for name in names:
+    for hash_, pkgs in itertools.groupby(_ordered_by_hash(db.get_pkgs(thresholds.MinLibCount)), lambda pkg: pkg.hash):
+        for name in _trim_names({ pkg.name for pkg in pkgs }):
             libs.append(LibInfo._make( (hash_, name) ))
 
+        if len(libs) >= LibBatchSize:
+            db.add_libs(libs)
+            libs = [ ]
+
         progress += 1
         if progress % 1000 == 0:
-            lx.info('%d/%d' % (progress, len(names_by_hash)))
-
-    lx.info('Updating library database...')
+            lx.info('%d hashes' % progress)
 
     db.add_libs(libs)
 
     lx.info('Done')
+
+
+def _ordered_by_hash(pkgs: Iterable[PkgInfo]) -> Iterable[PkgInfo]:
+    """Packages of `Database.get_pkgs`, which must be ordered by hash so each hash is one group
+    Lists (returned by databases written before the order was required) are sorted; an iterator out of
+    order raises ValueError instead of silently trimming names of split groups (though libraries
+    written before that are suspect).
+    """
+    if not isinstance(pkgs, Iterator):
+        return sorted(pkgs, key=lambda pkg: pkg.hash)
+    return _check_ordered(pkgs)
+
+def _check_ordered(pkgs: Iterator[PkgInfo]) -> Iterator[PkgInfo]:
+    last = None
+    for pkg in pkgs:
+        if last is not None and pkg.hash < last:
+            raise ValueError('Database.get_pkgs returned packages out of hash order (%s after %s)' % (pkg.hash.hex(), last.hex()))
+        last = pkg.hash
+        yield pkg
+
+
+def _update(thresholds, db):
+    """Only process packages changed since last update, and apply both new and removed libraries"""
+    lx.info('Loading changed packages...')
+
+    hashes = db.get_changed_hashes()
+    names_by_hash: Dict[bytes, Set[str]] = defaultdict(set)
+    for pkg in db.get_pkgs_of(hashes, thresholds.MinLibCount):
+        names_by_hash[pkg.hash].add(pkg.name)
+
+    lx.info('Trimming package names of %d hashes...' % len(hashes))
+
+    new_libs = set()
+    for hash_, names in names_by_hash.items():
+        for name in _trim_names(names):
+            new_libs.add(LibInfo._make( (hash_, name) ))
+    old_libs = set(db.match_libs(hashes))
+
+    lx.info('Updating library database...')
+
+    added = sorted(new_libs - old_libs)
+    removed = sorted(old_libs - new_libs)
+    if added:
+        db.add_libs(added)
+    if removed:
+        db.remove_libs(removed)
+    db.clear_changed(hashes)
+
+    lx.info('Done, %d libraries added, %d removed' % (len(added), len(removed)))
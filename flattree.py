@@ -0,0 +1,262 @@
+"""Array-backed alternative to `PackageTree`
+
+Nodes are indices into parallel arrays instead of `_TreeNode` objects, and every
+traversal uses an explicit stack, so large dex files need neither deep recursion
+nor per-node dicts. Results are identical to `PackageTree`.
+"""
+
+from __future__ import annotations
+
+from common import *
+
+from .stub import *
+from .pkgtree import _calc_leaf, _timed_scheme
+from . import stats
+
+from array import array
+from typing import Callable, Tuple
+
+
+class FlatPackageTree:
+    def __init__(self, dex: Dex, api_set: Union[Set[str], Dict[str, int]], hash_scheme: int = 1,
+            collect_apis: bool = False) -> None:
+        with stats.phase('tree.build'):
+            scheme, timers = _timed_scheme(hash_scheme)
+            package_hash = scheme[2]
+            self.pkg_apis: Dict[str, Set] = defaultdict(set)  # see `PackageTree`
+
+            # node 0 is root, other nodes are appended in creation order
+            self.name: List[str] = [ '' ]
+            self.hash: List[Optional[bytes]] = [ None ]
+            self.weight = array('q', [ 0 ])
+            self.is_leaf = bytearray(1)
+            self.first_child = array('i', [ -1 ])
+            self.last_child = array('i', [ -1 ])
+            self.next_sibling = array('i', [ -1 ])
+
+            # (parent, name segment) -> child, only needed while building
+            child_of: Dict[Tuple[int, str], int] = { }
+
+            for class_ in dex.classes:
+                name = class_.name()
+                assert name.startswith('L')
+                leaf_info = _calc_leaf(class_, api_set, scheme, self.pkg_apis if collect_apis else None)
+                if leaf_info is None: continue
+
+                segments = name[1:].split('/')
+                node = 0
+                for i, segment in enumerate(segments):
+                    if self.is_leaf[node]:
+                        raise TypeError('%s is inside class %s' % (name, self.name[node]))
+                    child = child_of.get( (node, segment) )
+                    if i == len(segments) - 1:  # the class itself
+                        if child is None:
+                            child = self._new_node(node)
+                            child_of[ (node, segment) ] = child
+                        else:  # replaces existing node at the same position
+                            self.first_child[child] = -1
+                            self.last_child[child] = -1
+                        self.name[child] = name
+                        self.hash[child], self.weight[child] = leaf_info
+                        self.is_leaf[child] = 1
+                    else:  # package on the path
+                        if child is None:
+                            child = self._new_node(node)
+                            child_of[ (node, segment) ] = child
+                            self.name[child] = 'L' + '/'.join(segments[ : i + 1 ])
+                    node = child
+
+            # calculate hash and weight, children before parents
+            self.preorder = self._preorder(lambda node: True)
+            for node in reversed(self.preorder):
+                if self.is_leaf[node]: continue
+                children = self.children(node)
+                self.hash[node] = package_hash([ self.hash[c] for c in children ])
+                self.weight[node] = sum( self.weight[c] for c in children )
+
+            # hash -> node; the last node wins if several nodes have the same hash, as in `PackageTree`
+            self.nodes: Dict[bytes, int] = { cast(bytes, self.hash[node]) : node for node in self.preorder }
+
+        if stats.enabled:
+            for timer in timers:
+                timer.flush()
+            stats.count('tree.leaves', sum( self.is_leaf[node] for node in self.preorder ))
+            stats.count('tree.nodes', len(self.preorder))
+            stats.count('tree.hashes', len(self.nodes))
+
+        # node -> mapping from potential library name to matched API weight; missing means empty
+        self.match_libs: Dict[int, Dict[str, int]] = { }
+        self.result_match_name: Dict[int, str] = { }
+        self.result_match_weight: Dict[int, int] = { }
+
+
+    def _new_node(self, parent: int) -> int:
+        node = len(self.name)
+        self.name.append('')
+        self.hash.append(None)
+        self.weight.append(0)
+        self.is_leaf.append(0)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        if self.first_child[parent] == -1:
+            self.first_child[parent] = node
+        else:
+            self.next_sibling[self.last_child[parent]] = node
+        self.last_child[parent] = node
+        return node
+
+    def children(self, node: int) -> List[int]:
+        ret = [ ]
+        child = self.first_child[node]
+        while child != -1:
+            ret.append(child)
+            child = self.next_sibling[child]
+        return ret
+
+    def _preorder(self, descend: Callable[[int], bool]) -> List[int]:
+        """List nodes in depth-first order; children of nodes where `descend` is false are skipped"""
+        ret = [ ]
+        stack = [ 0 ]
+        while stack:
+            node = stack.pop()
+            ret.append(node)
+            if descend(node):
+                stack += reversed(self.children(node))
+        return ret
+
+
+    def pkgs(self) -> List[PkgInfo]:
+        """Get hash, name and weight of all nodes"""
+        return [ PkgInfo(hash_, self.name[node], self.weight[node]) for hash_, node in self.nodes.items() ]
+
+
+    def set_db_match_result(self, exact_libs: List[LibInfo]):
+        with stats.phase('tree.set_db_match_result'):
+            for lib in exact_libs:
+                node = self.nodes[lib.hash]
+                self.match_libs.setdefault(node, { })[lib.name] = self.weight[node]
+
+
+    def detect_libs(self, match_rate_threshold: float, whitelist: Set[str]) -> List[PkgResult]:
+        """Calculate match rate of potential libraries, return matches above threshold"""
+        with stats.phase('tree.calc_match_rate'):
+            self.calc_match_rate()
+        with stats.phase('tree.gen_result'):
+            self.gen_result(whitelist)
+
+        ret = [ ]
+
+        for hash_, node in self.nodes.items():
+            name = self.name[node]
+            match_name = self.result_match_name.get(node)
+            if match_name is None:
+                similarity = None
+            else:
+                similarity = self.result_match_weight[node] / self.weight[node]
+
+            if similarity is not None and similarity >= match_rate_threshold:
+                ret.append(PkgResult(
+                    hash = hash_,
+                    name = name,
+                    lib_name = match_name,
+                    similarity = similarity
+                ))
+            elif name.lower() in whitelist:
+                if match_name != name:
+                    similarity = None
+                ret.append(PkgResult(
+                    hash = hash_,
+                    name = name,
+                    lib_name = name,
+                    similarity = similarity
+                ))
+
+        return ret
+
+
+    def detect_exact_libs(self) -> Dict[str, str]:
+        """Get perfectly matched libraries, excluding subpackages"""
+        ret: Dict[str, str] = { }
+        with stats.phase('tree.exact_libs'):
+            for node in self._preorder(lambda node: node not in self.match_libs):
+                if self.is_leaf[node] or node not in self.match_libs: continue
+                name = self.name[node]
+                pkgs = self.match_libs[node].keys()
+                ret[name] = name if name in pkgs else sorted(pkgs)[0]
+        return ret
+
+
+    def unmatched_pkgs(self, reported: Set[bytes]) -> List[PkgInfo]:
+        """See `PackageTree.unmatched_pkgs`"""
+        unmatched = lambda node: not (self.is_leaf[node] or self.hash[node] in reported or self._is_perfect(node))
+        hashes = { self.hash[node] for node in self._preorder(unmatched) if unmatched(node) }
+        return [ pkg for pkg in self.pkgs() if pkg.hash in hashes ]
+
+    def _is_perfect(self, node: int) -> bool:
+        """See `_TreeNode.is_perfect`"""
+        match = self.match_libs.get(node)
+        return match is not None and max(match.values()) == self.weight[node]
+
+
+    def calc_match_rate(self) -> None:
+        """See `_TreeNode.calc_match_rate`"""
+        # perfect matches and their subtrees are skipped
+        todo = self._preorder(lambda node: node not in self.match_libs)
+        for node in reversed(todo):
+            if self.is_leaf[node] or node in self.match_libs: continue
+
+            match: Dict[str, int] = defaultdict(int)
+            for c in self.children(node):
+                child_match: Dict[str, int] = defaultdict(int)
+                for child_pkg, weight in self.match_libs.get(c, { }).items():
+                    pkg = child_pkg.rsplit('/', 1)[0]
+                    child_match[pkg] = max(child_match[pkg], weight)
+                for pkg, weight in child_match.items():
+                    match[pkg] += weight
+
+            if len(match) > 0:
+                for pkg, weight in match.items():
+                    if weight > self.weight[node]:
+                        match[pkg] = self.weight[node]
+                self.match_libs[node] = match
+
+
+    def gen_result(self, whitelist: Set[str]) -> None:
+        """See `_TreeNode.gen_result`"""
+        stack = [ (0, False) ]
+        while stack:
+            node, parent_perfect = stack.pop()
+            if self.is_leaf[node]: continue
+            name = self.name[node]
+            match = self.match_libs.get(node)
+
+            if parent_perfect:
+                if name.lower() in whitelist and match is not None and name in match:
+                    self.result_match_name[node] = name
+                    self.result_match_weight[node] = match[name]
+                perfect = True
+
+            elif match is not None:
+                max_weight = max(match.values())
+                pkgs = sorted( p for p, w in match.items() if w == max_weight )
+
+                if len(pkgs) > max_weight:  # small feature size with too many potential names
+                    continue  # likely to be false-positive
+
+                if name in pkgs:
+                    self.result_match_name[node] = name
+                else:
+                    self.result_match_name[node] = pkgs[0]
+                    for pkg in pkgs:
+                        if pkg.lower() in whitelist:
+                            self.result_match_name[node] = pkg
+                            break
+
+                self.result_match_weight[node] = max_weight
+                perfect = self._is_perfect(node)
+
+            else:
+                perfect = False
+
+            stack += ( (child, perfect) for child in self.children(node) )
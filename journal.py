@@ -0,0 +1,162 @@
+"""Append-only journal of in-memory database writes
+
+Each write call appends one record, so persisting a write costs time proportional to its
+size, not to the database size. Loading replays the journal over the snapshot it belongs
+to; compaction writes a new snapshot and starts an empty journal.
+
+A journal belongs to the snapshot with the same epoch. Compaction first replaces the
+snapshot (with epoch + 1), then the journal, so a crash in between leaves a journal
+whose records are already in the snapshot, and which is ignored.
+
+File layout (little-endian):
+    header      magic, version, epoch
+    records     u32 payload size, u32 CRC-32 of payload, payload
+A record cut short by a crash fails its size or CRC check; it and anything after it
+are dropped.
+
+Payloads start with a type byte:
+    b'P'    package counts: rows of 20-byte hash, i32 count, i64 weight (-1 if unchanged), u16 size, name
+    b'L'    libraries added: u64 new generation, rows of 20-byte hash, u16 size, name
+    b'D'    libraries removed: same as b'L'
+    b'C'    changed hashes cleared: 20-byte hashes
+    b'S'    hash scheme: u32
+    b'X'    signatures: rows of 20-byte hash, signature (see lsh.py)
+"""
+
+from common import *
+
+from .snapshot import HashSize
+from . import lsh
+
+from typing import BinaryIO, Tuple
+import os
+import struct
+import zlib
+
+
+Magic = b'LIBJRNL\0'
+Version = 1
+
+_header = struct.Struct('<8sIQ')
+_record = struct.Struct('<II')
+_count = struct.Struct('<iqH')
+_name = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+
+_SignatureSize = lsh.SignatureSize * 4
+
+
+def encode_counts(rows: Iterable[Tuple[bytes, str, int, int]]) -> bytes:
+    """Encode (hash, name, count, weight) rows"""
+    parts = [ b'P' ]
+    for hash_, name, count, weight in rows:
+        data = name.encode('utf8')
+        parts += [ hash_, _count.pack(count, weight, len(data)), data ]
+    return b''.join(parts)
+
+def encode_libs(type_: bytes, generation: int, rows: Iterable[Tuple[bytes, str]]) -> bytes:
+    parts = [ type_, _u64.pack(generation) ]
+    for hash_, name in rows:
+        data = name.encode('utf8')
+        parts += [ hash_, _name.pack(len(data)), data ]
+    return b''.join(parts)
+
+def encode_hashes(hashes: Iterable[bytes]) -> bytes:
+    return b'C' + b''.join(hashes)
+
+def encode_scheme(scheme: int) -> bytes:
+    return b'S' + _u32.pack(scheme)
+
+def encode_signatures(signatures: Dict[bytes, bytes]) -> bytes:
+    return b'X' + b''.join( hash_ + signature for hash_, signature in signatures.items() )
+
+
+def decode(payload: bytes) -> Tuple[bytes, Any]:
+    """Decode a record payload into its type and content, see `encode_*` functions"""
+    type_ = payload[ : 1 ]
+    pos = 1
+    if type_ == b'P':
+        rows = [ ]
+        while pos < len(payload):
+            hash_ = payload[ pos : pos + HashSize ]
+            count, weight, size = _count.unpack_from(payload, pos + HashSize)
+            pos += HashSize + _count.size
+            rows.append( (hash_, str(payload[ pos : pos + size ], 'utf8'), count, weight) )
+            pos += size
+        return type_, rows
+    if type_ in (b'L', b'D'):
+        generation, = _u64.unpack_from(payload, pos)
+        pos += _u64.size
+        libs = [ ]
+        while pos < len(payload):
+            hash_ = payload[ pos : pos + HashSize ]
+            size, = _name.unpack_from(payload, pos + HashSize)
+            pos += HashSize + _name.size
+            libs.append( (hash_, str(payload[ pos : pos + size ], 'utf8')) )
+            pos += size
+        return type_, (generation, libs)
+    if type_ == b'C':
+        return type_, [ payload[ i : i + HashSize ] for i in range(pos, len(payload), HashSize) ]
+    if type_ == b'S':
+        return type_, _u32.unpack_from(payload, pos)[0]
+    if type_ == b'X':
+        size = HashSize + _SignatureSize
+        return type_, { payload[ i : i + HashSize ] : payload[ i + HashSize : i + size ] for i in range(pos, len(payload), size) }
+    raise ValueError('Unknown journal record %r' % type_)
+
+
+def read(path: str) -> Tuple[int, List[bytes], int]:
+    """Get epoch, record payloads and size of the valid part of a journal"""
+    with open(path, 'rb') as f:
+        magic, version, epoch = _header.unpack(f.read(_header.size))
+        if magic != Magic:
+            raise ValueError('%s is not a journal' % path)
+        if version != Version:
+            raise ValueError('Unsupported journal version %d' % version)
+        payloads = [ ]
+        valid_size = _header.size
+        while True:
+            header = f.read(_record.size)
+            if len(header) == 0: break
+            if len(header) < _record.size:
+                lx.warning('Dropping incomplete record at the end of %s' % path)
+                break
+            size, crc = _record.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                lx.warning('Dropping incomplete record at the end of %s' % path)
+                break
+            payloads.append(payload)
+            valid_size += _record.size + size
+    return epoch, payloads, valid_size
+
+
+class Writer:
+    def __init__(self, path: str, epoch: int, valid_size: Optional[int] = None) -> None:
+        """Append to journal at `path` after its first `valid_size` bytes, or start an empty journal if it is None"""
+        if valid_size is None:
+            create(path, epoch)
+            valid_size = _header.size
+        self._file: BinaryIO = open(path, 'r+b')
+        self._file.truncate(valid_size)  # drop incomplete record left by a crash
+        self._file.seek(valid_size)
+
+    def append(self, payload: bytes) -> None:
+        """Append a record and wait until it is on disk"""
+        self._file.write(_record.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def create(path: str, epoch: int) -> None:
+    """Start an empty journal atomically (in a temporary file which then replaces `path`)"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_header.pack(Magic, Version, epoch))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
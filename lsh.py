@@ -0,0 +1,182 @@
+"""Approximate similarity index of library packages
+
+Exact matching only credits packages whose hash is in the library database, so a new
+version of a library where most classes changed slightly is not detected at all.
+
+Each package gets a MinHash signature of the set of APIs it invokes. The fraction of
+equal positions in two signatures estimates Jaccard similarity of the two API sets.
+Signatures are split into bands; packages sharing any band are candidates (locality-
+sensitive hashing), so a query compares against few libraries instead of all of them.
+
+Signature file layout (little-endian):
+    header      magic, version, signature size, count
+    records     count x (20-byte hash, signature size x u32)
+"""
+
+from common import *
+
+from .stub import *
+from . import vocab
+
+from array import array
+from typing import Iterator, Tuple
+import bisect
+import hashlib
+import operator
+import os
+import random
+import struct
+
+
+##  Number of hash functions in a signature, and number of bands it is split into
+##  Packages with Jaccard similarity s share at least one band with probability 1 - (1 - s ^ (size / bands)) ^ bands
+SignatureSize = 64
+Bands = 16
+
+##  Band buckets larger than this (e.g. tiny packages invoking one common API) are skipped in queries
+MaxBucketSize = 100
+
+_Prime = (1 << 61) - 1
+_rng = random.Random('minhash')
+_permutations = [ (_rng.randrange(1, _Prime), _rng.randrange(_Prime)) for _ in range(SignatureSize) ]
+_signature_struct = struct.Struct('<%dI' % SignatureSize)
+
+# API name or id (see `vocab.api_ids`) -> its signature, i.e. its value under each hash function
+_api_signatures: Dict[Union[str, int], array] = { }
+
+# API id -> name
+_api_names: List[str] = [ ]
+
+Magic = b'LIBSIGS\0'
+Version = 1
+_header = struct.Struct('<8sIIQ')
+_HashSize = 20
+
+
+def _api_signature(api: Union[str, int]) -> array:
+    """Signature of an API; an id has the signature of its name, so signatures do not depend on hash scheme"""
+    global _api_names
+    ret = _api_signatures.get(api)
+    if ret is None:
+        if isinstance(api, int):
+            if len(_api_names) == 0:
+                _api_names = sorted(vocab.api_ids(), key=vocab.api_ids().__getitem__)
+            name = _api_names[api]
+        else:
+            name = api
+        x = int.from_bytes(hashlib.blake2b(name.encode('utf8'), digest_size=8).digest(), 'little')
+        ret = array('I', [ ((a * x + b) % _Prime) & 0xffffffff for a, b in _permutations ])
+        _api_signatures[api] = ret
+    return ret
+
+def _union(signatures: List[array]) -> array:
+    """Signature of the union of sets"""
+    if len(signatures) == 1:
+        return array('I', signatures[0])
+    return array('I', map(min, *signatures))
+
+
+def pkg_signatures(own_apis: Dict[str, Set]) -> Dict[str, array]:
+    """Get MinHash signature of the API set of each package, by package name
+    `own_apis` maps package name to APIs (names or ids) invoked by its own classes, see `PackageTree.pkg_apis`;
+    APIs of subpackages are merged into their parents here.
+    """
+    ret = { pkg : _union([ _api_signature(api) for api in apis ]) for pkg, apis in own_apis.items() }
+
+    # merge into parent packages, deepest first
+    by_depth: Dict[int, Set[str]] = defaultdict(set)
+    for pkg in ret:
+        by_depth[pkg.count('/')].add(pkg)
+    for depth in range(max(by_depth, default=0), 0, -1):
+        for pkg in by_depth[depth]:
+            parent = pkg.rsplit('/', 1)[0]
+            old = ret.get(parent)
+            ret[parent] = ret[pkg] if old is None else array('I', map(min, old, ret[pkg]))
+            by_depth[depth - 1].add(parent)
+    return ret
+
+def to_bytes(signature: array) -> bytes:
+    return _signature_struct.pack(*signature)
+
+def similarity(a: array, b: array) -> float:
+    """Estimated Jaccard similarity of two API sets"""
+    return sum(map(operator.eq, a, b)) / SignatureSize
+
+def _band_keys(signature: array) -> List[int]:
+    rows = SignatureSize // Bands
+    return [ hash(tuple(signature[ i * rows : (i + 1) * rows ])) for i in range(Bands) ]
+
+
+class SimilarityIndex:
+    """Libraries indexed by bands of their signatures
+    Each band is a sorted array of band keys with a parallel array of library numbers.
+    """
+
+    def __init__(self, libs: Iterable[Tuple[bytes, List[str], bytes]]) -> None:
+        """Index (hash, names, signature bytes) of libraries"""
+        self.hashes: List[bytes] = [ ]
+        self.names: List[List[str]] = [ ]
+        self._signatures = array('I')
+        for hash_, names, signature in libs:
+            self.hashes.append(hash_)
+            self.names.append(names)
+            self._signatures.extend(_signature_struct.unpack(signature))
+
+        self._keys: List[array] = [ ]
+        self._libs: List[array] = [ ]
+        all_keys = [ _band_keys(self.signature(lib)) for lib in range(len(self.hashes)) ]
+        for band in range(Bands):
+            keys = [ k[band] for k in all_keys ]
+            order = sorted(range(len(keys)), key = keys.__getitem__)
+            self._keys.append(array('q', [ keys[lib] for lib in order ]))
+            self._libs.append(array('i', order))
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def signature(self, lib: int) -> array:
+        return self._signatures[ lib * SignatureSize : (lib + 1) * SignatureSize ]
+
+    def query(self, signature: array, min_similarity: float) -> List[Tuple[float, int]]:
+        """Get (estimated similarity, library number) of similar libraries, most similar first"""
+        candidates: Set[int] = set()
+        for band, key in enumerate(_band_keys(signature)):
+            keys = self._keys[band]
+            start = bisect.bisect_left(keys, key)
+            end = bisect.bisect_right(keys, key, start, min(len(keys), start + MaxBucketSize + 1))
+            if end - start <= MaxBucketSize:
+                candidates.update(self._libs[band][ start : end ])
+
+        ret = [ ]
+        for lib in candidates:
+            s = similarity(signature, self.signature(lib))
+            if s >= min_similarity:
+                ret.append( (s, lib) )
+        ret.sort(key = lambda item: (-item[0], self.hashes[item[1]]))
+        return ret
+
+
+def write_signatures(path: str, signatures: Iterable[Tuple[bytes, bytes]]) -> None:
+    """Write (hash, signature bytes) atomically (to a temporary file which then replaces `path`)"""
+    rows = sorted(signatures)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_header.pack(Magic, Version, SignatureSize, len(rows)))
+        for hash_, signature in rows:
+            f.write(hash_)
+            f.write(signature)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_signatures(path: str) -> Iterator[Tuple[bytes, bytes]]:
+    with open(path, 'rb') as f:
+        magic, version, size, count = _header.unpack(f.read(_header.size))
+        if magic != Magic:
+            raise ValueError('%s is not a signature file' % path)
+        if version != Version or size != SignatureSize:
+            raise ValueError('Unsupported signature file version %d with signature size %d' % (version, size))
+        record_size = _HashSize + _signature_struct.size
+        for _ in range(count):
+            record = f.read(record_size)
+            yield record[ : _HashSize ], record[ _HashSize : ]
@@ -1,73 +1,404 @@
 from common import *
 
 from .stub import *
+from . import vocab
+from . import snapshot
+from . import lsh
+from .pkgstore import PkgStore, NoWeight
+from . import journal
+from . import stats
 
 from contextlib import suppress
+from typing import Callable, Iterator, Tuple
 import os
 
 
-# hash -> pkg_name -> count
-_db_pkgs: Dict[bytes, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+# hash -> pkg_name -> count, and hash -> weight; packages whose count falls to zero are dropped
+_db_pkgs = PkgStore()
 # hash -> pkg_name's
 _db_libs: Dict[bytes, Set[str]] = defaultdict(set)
-# hash -> weight
-_db_weight: Dict[bytes, int] = { }
+# hashes added or removed since they were last processed by library update
+_changed: Set[bytes] = set()
+# hash -> MinHash signature of package API set, only recorded when similarity index is enabled
+_db_signatures: Dict[bytes, bytes] = { }
 
+# memory-mapped snapshot, whose sections are copied into the dicts above on first write
+_snapshot: Optional[snapshot.Snapshot] = None
+_snapshot_pkgs = False  # `_db_pkgs` is still in snapshot
+_snapshot_libs = False  # `_db_libs` is still in snapshot
 
-api_set: Set[str] = set(lx.read_lines(lx.open_resource('apis.txt')))
-lib_set: Set[str] = set(lx.read_lines(lx.open_resource('libs.txt')))
+snapshot_file = 'db_snapshot.bin'
+signature_file = 'db_signatures.bin'
+journal_file = 'db_journal.bin'
+
+# writes are lost unless `dump` is called, or journal is enabled
+durable = False
+
+# writes are appended to journal file when enabled, see `enable_journal`
+_use_journal = False
+_journal: Optional[journal.Writer] = None
+_journal_size: Optional[int] = None  # size of valid part of loaded journal, None if it does not belong to snapshot
+
+# journal epoch of loaded snapshot, incremented by each dump
+_epoch = 0
+
+# the database is loaded from file system on first use
+_loaded = False
+
+# hash scheme of all hashes in the database, see `pkgtree.HashSchemes`
+_hash_scheme = 1
+
+# incremented whenever the library database changes
+_generation = 0
+
+
+api_set: Set[str]
+api_ids: Dict[str, int]
+lib_set: Set[str]
+hash_scheme: int
+generation: int
+
+def __getattr__(name: str) -> Any:
+    # these attributes are loaded on first access
+    if name == 'api_set': return vocab.api_set()
+    if name == 'api_ids': return vocab.api_ids()
+    if name == 'lib_set': return vocab.lib_set()
+    if name == 'hash_scheme':
+        _lazy_load()
+        return _hash_scheme
+    if name == 'generation':
+        _lazy_load()
+        return _generation
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 def match_libs(hash_list: Iterable[bytes]) -> List[LibInfo]:
+    _lazy_load()
+    if _snapshot_libs:
+        lookup = cast(snapshot.Snapshot, _snapshot).match_libs
+    else:
+        lookup = lambda hash_: _db_libs.get(hash_, ())
     ret = [ ]
     for hash_ in hash_list:
-        for pkg in _db_libs[hash_]:
+        for pkg in lookup(hash_):
             ret.append(LibInfo(hash_, pkg))
     return ret
 
 def add_pkgs(pkgs: List[PkgInfo]) -> None:
-    for pkg in pkgs:
-        _db_pkgs[pkg.hash][pkg.name] += 1
-        _db_weight[pkg.hash] = pkg.weight
+    _add_counts([ (pkg.hash, pkg.name, 1, pkg.weight) for pkg in pkgs ])
+
+def add_pkg_counts(pkgs: List[Tuple[PkgInfo, int]]) -> None:
+    _add_counts([ (pkg.hash, pkg.name, count, pkg.weight) for pkg, count in pkgs ])
 
 def remove_pkgs(pkgs: List[PkgInfo]) -> None:
-    for pkg in pkgs:
-        _db_pkgs[pkg.hash][pkg.name] -= 1
+    _add_counts([ (pkg.hash, pkg.name, -1, NoWeight) for pkg in pkgs ])
 
-def get_pkgs(threshold: int) -> List[PkgInfo]:
+def _add_counts(rows: List[Tuple[bytes, str, int, int]]) -> None:
+    """Add (hash, name, count, weight) rows; weight is not changed if it is `NoWeight`"""
+    _lazy_load()
+    _materialize_pkgs()
+    _append_journal(journal.encode_counts, rows)
+    _apply_counts(rows)
+    if stats.enabled:
+        stats.count('db.write_rows', len(rows))
+
+def _apply_counts(rows: List[Tuple[bytes, str, int, int]]) -> None:
+    for hash_, name, count, weight in rows:
+        _db_pkgs.add(hash_, name, count, weight)
+        _changed.add(hash_)
+
+def get_pkgs(threshold: int) -> Iterator[PkgInfo]:
+    _lazy_load()
+    _materialize_pkgs()
+    for row in _db_pkgs.at_least(threshold):
+        yield PkgInfo._make(row)
+
+def get_changed_hashes() -> Set[bytes]:
+    _lazy_load()
+    _materialize_pkgs()
+    return set(_changed)
+
+def get_pkgs_of(hashes: Iterable[bytes], threshold: int) -> List[PkgInfo]:
+    _lazy_load()
+    _materialize_pkgs()
     ret = [ ]
-    for hash_, pkg_cnt in _db_pkgs.items():
-        w = _db_weight[hash_]
-        for pkg, cnt in pkg_cnt.items():
+    for hash_ in hashes:
+        if hash_ not in _db_pkgs: continue
+        w = _db_pkgs.weight(hash_)
+        for pkg, cnt in _db_pkgs.counts(hash_):
             if cnt >= threshold:
                 ret.append(PkgInfo._make( (hash_, pkg, w) ))
     return ret
 
+def clear_changed(hashes: Iterable[bytes]) -> None:
+    _lazy_load()
+    _materialize_pkgs()
+    hashes = list(hashes)
+    _append_journal(journal.encode_hashes, hashes)
+    _changed.difference_update(hashes)
+
+def add_signatures(signatures: Dict[bytes, bytes]) -> None:
+    _lazy_load()
+    _append_journal(journal.encode_signatures, signatures)
+    _db_signatures.update(signatures)
+
+def get_lib_signatures() -> Iterator[Tuple[bytes, List[str], bytes]]:
+    _lazy_load()
+    _materialize_libs()
+    for hash_, pkgs in _db_libs.items():
+        signature = _db_signatures.get(hash_)
+        if signature is not None:
+            yield hash_, sorted(pkgs), signature
+
+def get_lib_hashes() -> List[bytes]:
+    _lazy_load()
+    if _snapshot_libs:
+        return list(cast(snapshot.Snapshot, _snapshot).lib_hashes())
+    return list(_db_libs)
+
 def add_libs(libs: List[LibInfo]) -> None:
-    for lib in libs:
-        _db_libs[lib.hash].add(lib.name)
+    _lazy_load()
+    _materialize_libs()
+    _append_journal(journal.encode_libs, b'L', _generation + 1, libs)
+    _apply_add_libs(libs, _generation + 1)
+
+def remove_libs(libs: List[LibInfo]) -> None:
+    _lazy_load()
+    _materialize_libs()
+    _append_journal(journal.encode_libs, b'D', _generation + 1, libs)
+    _apply_remove_libs(libs, _generation + 1)
+
+def _apply_add_libs(libs: Iterable[Tuple[bytes, str]], generation: int) -> None:
+    global _generation
+    for hash_, name in libs:
+        _db_libs[hash_].add(name)
+    _generation = generation
+
+def _apply_remove_libs(libs: Iterable[Tuple[bytes, str]], generation: int) -> None:
+    global _generation
+    for hash_, name in libs:
+        names = _db_libs.get(hash_)
+        if names is None: continue
+        names.discard(name)
+        if len(names) == 0:
+            del _db_libs[hash_]
+    _generation = generation
 
 
 def preload() -> None:
     lx.warning('Trying to pre-download memory database')
 
+def refresh() -> None:
+    lx.warning('Trying to refresh memory database')
+
 def dump() -> None:
+    """Write the database to a binary snapshot, and start an empty journal"""
+    global _epoch, _journal, _journal_size
+    _lazy_load()
+    with stats.phase('db.dump'):
+        _materialize_pkgs()
+        _materialize_libs()
+        if _db_signatures or os.path.exists(signature_file):
+            # written first: unlike the snapshot, it is not guarded by journal epoch
+            lsh.write_signatures(signature_file, _db_signatures.items())
+        snapshot.write(
+            snapshot_file,
+            _db_pkgs.items(),
+            ( (hash_, pkg) for hash_, pkgs in _db_libs.items() for pkg in pkgs ),
+            _db_pkgs.weights(),
+            _hash_scheme,
+            _generation,
+            _changed,
+            _epoch + 1
+        )
+        _epoch += 1
+        # old journal is ignored from now on; next write starts a new one
+        if _journal is not None:
+            _journal.close()
+            _journal = None
+        _journal_size = None
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
+
+def compact() -> None:
+    """Fold the journal into a new snapshot; same as `dump`"""
+    dump()
+
+def enable_journal(enabled: bool = True) -> None:
+    """Append each write to a journal file (see journal.py), so writes survive without `dump`
+    Each write then costs time proportional to its size, and `load` replays the journal.
+    Call `compact` (or `dump`) from time to time to fold the journal into the snapshot.
+    """
+    global durable, _use_journal, _journal
+    durable = _use_journal = enabled
+    if not enabled and _journal is not None:
+        _journal.close()
+        _journal = None
+
+def _append_journal(encode: Callable[..., bytes], *args: Any) -> None:
+    global _journal
+    if not _use_journal: return
+    if _journal is None:
+        _journal = journal.Writer(journal_file, _epoch, _journal_size)
+    with stats.phase('db.journal'):
+        _journal.append(encode(*args))
+
+def load() -> None:
+    """Load the database from binary snapshot, or from text files if there is no snapshot
+    Either replaces current content, so loading again gives the same database.
+    Snapshot is memory-mapped; text files are parsed.
+    """
+    global _snapshot, _snapshot_pkgs, _snapshot_libs, _loaded, _hash_scheme, _generation, _epoch, _journal
+    _loaded = True
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+    _db_pkgs.clear()
+    _db_libs.clear()
+    _changed.clear()
+    _db_signatures.clear()
+    _snapshot = None
+    _snapshot_pkgs = False
+    _snapshot_libs = False
+    if not os.path.exists(snapshot_file):
+        _hash_scheme = 1
+        _generation = 0
+        _epoch = 0
+        # not `load_text`, which may journal a change of hash scheme before the journal is replayed
+        _hash_scheme, generation = _read_meta()
+        _read_text(generation)
+        _replay_journal()
+        return
+    if os.path.exists(signature_file):
+        _db_signatures.update(lsh.read_signatures(signature_file))
+    _snapshot = snapshot.Snapshot(snapshot_file)
+    _hash_scheme = _snapshot.hash_scheme
+    _generation = _snapshot.generation
+    _epoch = _snapshot.epoch
+    _snapshot_pkgs = True
+    _snapshot_libs = True
+    _replay_journal()
+
+def _replay_journal() -> None:
+    """Apply journal records written after the loaded snapshot"""
+    global _journal_size, _hash_scheme
+    _journal_size = None
+    if not os.path.exists(journal_file): return
+    epoch, payloads, valid_size = journal.read(journal_file)
+    if epoch != _epoch:
+        lx.info('Ignoring %s of another snapshot' % journal_file)
+        return
+    _journal_size = valid_size
+    with stats.phase('db.replay_journal'):
+        for payload in payloads:
+            type_, content = journal.decode(payload)
+            if type_ == b'P':
+                _materialize_pkgs()
+                _apply_counts(content)
+            elif type_ == b'L':
+                _materialize_libs()
+                _apply_add_libs(content[1], content[0])
+            elif type_ == b'D':
+                _materialize_libs()
+                _apply_remove_libs(content[1], content[0])
+            elif type_ == b'C':
+                _materialize_pkgs()
+                _changed.difference_update(content)
+            elif type_ == b'S':
+                _hash_scheme = content
+            elif type_ == b'X':
+                _db_signatures.update(content)
+    if len(payloads) > 0:
+        lx.info('Replayed %d journal records' % len(payloads))
+
+def set_hash_scheme(scheme: int) -> None:
+    """Change hash scheme of an empty database
+    Use rehash.py to migrate a non-empty database
+    """
+    global _hash_scheme
+    _lazy_load()
+    if scheme == _hash_scheme: return
+    if not _is_empty():
+        raise ValueError('Cannot change hash scheme of a non-empty database')
+    _append_journal(journal.encode_scheme, scheme)
+    _hash_scheme = scheme
+
+def _is_empty() -> bool:
+    _lazy_load()
+    _materialize_pkgs()
+    _materialize_libs()
+    return len(_db_pkgs) == 0 and len(_db_libs) == 0
+
+def _lazy_load() -> None:
+    if not _loaded:
+        load()
+
+def _materialize_pkgs() -> None:
+    global _snapshot_pkgs
+    if not _snapshot_pkgs: return
+    with stats.phase('db.materialize_pkgs'):
+        for hash_, pkg, cnt in cast(snapshot.Snapshot, _snapshot).pkgs():
+            _db_pkgs.set_count(hash_, pkg, cnt)
+        for hash_, weight in cast(snapshot.Snapshot, _snapshot).weights():
+            _db_pkgs.set_weight(hash_, weight)
+        _changed.update(cast(snapshot.Snapshot, _snapshot).changed())
+    _snapshot_pkgs = False
+
+def _materialize_libs() -> None:
+    global _snapshot_libs
+    if not _snapshot_libs: return
+    for hash_, pkg in cast(snapshot.Snapshot, _snapshot).libs():
+        _db_libs[hash_].add(pkg)
+    _snapshot_libs = False
+
+
+def dump_text() -> None:
+    """Export the database as text files, for migration"""
+    _lazy_load()
+    _materialize_pkgs()
+    _materialize_libs()
     with open('db_pkgs.txt', 'w') as f:
-        for hash_, pkg_cnt in _db_pkgs.items():
-            for pkg, cnt in pkg_cnt.items():
-                f.write('%s %s %d\n' % (hash_.hex(), pkg, cnt))
+        for hash_, pkg, cnt in _db_pkgs.items():
+            f.write('%s %s %d\n' % (hash_.hex(), pkg, cnt))
     with open('db_libs.txt', 'w') as f:
         for hash_, pkgs in _db_libs.items():
             for pkg in sorted(pkgs):
                 f.write('%s %s\n' % (hash_.hex(), pkg))
     with open('db_weights.txt', 'w') as f:
-        for hash_, weight in _db_weight.items():
+        for hash_, weight in _db_pkgs.weights():
             f.write('%s %d\n' % (hash_.hex(), weight))
+    with open('db_meta.txt', 'w') as f:
+        f.write('hash_scheme %d\n' % _hash_scheme)
+        f.write('generation %d\n' % _generation)
 
-def load() -> None:
+def load_text() -> None:
+    """Import text files exported by `dump_text`"""
+    _lazy_load()
+    scheme, generation = _read_meta()
+    set_hash_scheme(scheme)  # refuse to mix hashes of different schemes
+    _read_text(generation)
+
+def _read_meta() -> Tuple[int, int]:
+    """Get (hash scheme, generation) of text files"""
+    scheme = 1  # files exported before hash schemes were introduced
+    generation = 0
+    with suppress(FileNotFoundError):
+        for line in lx.read_lines('db_meta.txt'):
+            key, value = line.split(' ')
+            if key == 'hash_scheme':
+                scheme = int(value)
+            if key == 'generation':
+                generation = int(value)
+    return scheme, generation
+
+def _read_text(generation: int) -> None:
+    global _generation
+    _materialize_pkgs()
+    _materialize_libs()
     with suppress(FileNotFoundError):
         for line in lx.read_lines('db_pkgs.txt'):
             hash_, pkg, cnt = line.split(' ')
-            _db_pkgs[bytes.fromhex(hash_)][pkg] = int(cnt)
+            _db_pkgs.set_count(bytes.fromhex(hash_), pkg, int(cnt))
+            _changed.add(bytes.fromhex(hash_))  # imported packages are new to library database
     with suppress(FileNotFoundError):
         for line in lx.read_lines('db_libs.txt'):
             hash_, pkg = line.split(' ')
@@ -75,4 +406,5 @@ def load() -> None:
     with suppress(FileNotFoundError):
         for line in lx.read_lines('db_weights.txt'):
             hash_, weight = line.split(' ')
-            _db_weight[bytes.fromhex(hash_)] = int(weight)
+            _db_pkgs.set_weight(bytes.fromhex(hash_), int(weight))
+    _generation = max(_generation, generation) + 1
@@ -0,0 +1,317 @@
+"""Compact storage of package counts for the in-memory database
+
+Each hash gets a slot: its digest is stored in one byte string, and its weight and
+rows live in array columns. An open-addressing table of slot numbers maps hashes to
+slots. Each (hash, name) pair gets a row in array columns (name id, count, slot, next
+row of the same hash), with package names interned in a shared string table.
+So a row costs a few machine words instead of nested dict entries and its own string.
+
+Counts never go below zero. A row whose count falls to zero is deleted, and so is a
+slot (with its weight) whose last row is deleted, and a name whose last row is deleted;
+their positions and ids are reused by new rows, slots and names, so memory follows live
+packages as packages are added and removed.
+
+Rows appearing at least twice are indexed by count: bucket b holds rows with count in
+[2^b, 2^(b+1)). Counts change by small steps, so rows rarely move between buckets, and
+`at_least` only reads buckets which may reach the threshold. Most packages appear once
+and are not indexed.
+"""
+
+from common import *
+
+from .snapshot import HashSize
+
+from array import array
+from typing import Iterator, Tuple
+
+
+NoWeight = -1  # weight argument which does not change the weight
+
+##  Maximum ratio of used entries in hash -> slot table before it grows
+MaxTableLoad = 0.6
+
+
+class PkgStore:
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        # interned names and their number of rows; a freed name is empty
+        self._names: List[str] = [ ]
+        self._name_ids: Dict[str, int] = { }
+        self._name_rows = array('i')
+        self._free_names = array('i')
+        # hash -> slot, open addressing with linear probing; -1 is empty
+        self._table = array('i', [ -1 ]) * 8
+        # slot columns; a deleted slot has no first row
+        self._hashes = bytearray()
+        self._weights = array('q')
+        self._first_row = array('i')
+        self._last_row = array('i')
+        self._free_slots = array('i')
+        self._live_slots = 0
+        # row columns; rows of one hash form a linked list; a deleted row has slot -1
+        self._row_name = array('i')
+        self._row_count = array('i')
+        self._row_slot = array('i')
+        self._row_next = array('i')
+        self._row_pos = array('i')  # position in its count bucket, -1 if not indexed
+        self._free_rows = array('i')
+        # count buckets, see module docstring; buckets 0 is always empty
+        self._buckets: List[array] = [ array('i') ]
+
+    def __len__(self) -> int:
+        """Number of hashes"""
+        return self._live_slots
+
+    def __contains__(self, hash_: bytes) -> bool:
+        return self._table[self._probe(hash_)] != -1
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Iterate hashes"""
+        for slot in range(len(self._weights)):
+            if self._first_row[slot] != -1:
+                yield self._hash(slot)
+
+    def _hash(self, slot: int) -> bytes:
+        return bytes(self._hashes[ slot * HashSize : (slot + 1) * HashSize ])
+
+
+    def add(self, hash_: bytes, name: str, count: int, weight: int = NoWeight) -> None:
+        """Add `count` (may be negative) to the count of a package, and set its weight if given"""
+        slot = self._slot(hash_, count > 0)
+        if slot == -1: return  # removing a package which is not recorded
+        if weight != NoWeight:
+            self._weights[slot] = weight
+        row = self._row(slot, name, count > 0)
+        if row == -1: return
+        self._set_row_count(row, max(self._row_count[row] + count, 0))
+
+    def set_count(self, hash_: bytes, name: str, count: int) -> None:
+        slot = self._slot(hash_, count > 0)
+        if slot == -1: return
+        row = self._row(slot, name, count > 0)
+        if row == -1: return
+        self._set_row_count(row, max(count, 0))
+
+    def set_weight(self, hash_: bytes, weight: int) -> None:
+        """Set weight of a recorded hash; unknown hashes are ignored"""
+        slot = self._table[self._probe(hash_)]
+        if slot != -1:
+            self._weights[slot] = weight
+
+    def _probe(self, hash_: bytes) -> int:
+        """Get index of `hash_` in table, or of the empty entry where it belongs"""
+        assert len(hash_) == HashSize
+        table = self._table
+        hashes = self._hashes
+        mask = len(table) - 1
+        i = int.from_bytes(hash_[ : 8 ], 'little') & mask  # hashes are uniformly distributed
+        while True:
+            slot = table[i]
+            if slot == -1 or hashes[ slot * HashSize : (slot + 1) * HashSize ] == hash_:
+                return i
+            i = (i + 1) & mask
+
+    def _home(self, slot: int) -> int:
+        """Get index in table where probing for hash of `slot` starts"""
+        return int.from_bytes(self._hashes[ slot * HashSize : slot * HashSize + 8 ], 'little') & (len(self._table) - 1)
+
+    def _slot(self, hash_: bytes, create: bool) -> int:
+        """Get slot of a hash, creating it if `create` is true, otherwise -1 if missing"""
+        i = self._probe(hash_)
+        slot = self._table[i]
+        if slot != -1 or not create:
+            return slot
+
+        if self._live_slots + 1 > len(self._table) * MaxTableLoad:
+            self._grow_table()
+            i = self._probe(hash_)
+        if len(self._free_slots) > 0:
+            slot = self._free_slots.pop()
+            self._hashes[ slot * HashSize : (slot + 1) * HashSize ] = hash_
+        else:
+            slot = len(self._weights)
+            self._hashes += hash_
+            self._weights.append(NoWeight)
+            self._first_row.append(-1)
+            self._last_row.append(-1)
+        self._table[i] = slot
+        self._live_slots += 1
+        return slot
+
+    def _grow_table(self) -> None:
+        self._table = array('i', [ -1 ]) * (len(self._table) * 2)
+        for slot in range(len(self._weights)):
+            if self._first_row[slot] != -1:
+                self._table[self._probe(self._hash(slot))] = slot
+
+    def _delete_slot(self, slot: int) -> None:
+        """Remove a slot without rows from table (moving back entries probed past it), and free it"""
+        table = self._table
+        mask = len(table) - 1
+        i = self._probe(self._hash(slot))
+        j = i
+        while True:
+            table[i] = -1
+            while True:
+                j = (j + 1) & mask
+                moved = table[j]
+                if moved == -1:
+                    self._weights[slot] = NoWeight
+                    self._free_slots.append(slot)
+                    self._live_slots -= 1
+                    return
+                home = self._home(moved)
+                # the entry can fill the hole at `i` unless its home is cyclically in (i, j]
+                if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                    break
+            table[i] = moved
+            i = j
+
+    def _row(self, slot: int, name: str, create: bool) -> int:
+        """Get row of a package, creating it if `create` is true, otherwise -1 if missing"""
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            if not create: return -1
+            if len(self._free_names) > 0:
+                name_id = self._free_names.pop()
+                self._names[name_id] = name
+            else:
+                name_id = len(self._names)
+                self._names.append(name)
+                self._name_rows.append(0)
+            self._name_ids[name] = name_id
+
+        row = self._first_row[slot]
+        while row != -1:
+            if self._row_name[row] == name_id:
+                return row
+            row = self._row_next[row]
+        if not create: return -1
+
+        self._name_rows[name_id] += 1
+        if len(self._free_rows) > 0:
+            row = self._free_rows.pop()
+            self._row_name[row] = name_id
+            self._row_slot[row] = slot
+        else:
+            row = len(self._row_name)
+            self._row_name.append(name_id)
+            self._row_count.append(0)
+            self._row_slot.append(slot)
+            self._row_next.append(-1)
+            self._row_pos.append(-1)
+        if self._first_row[slot] == -1:
+            self._first_row[slot] = row
+        else:
+            self._row_next[self._last_row[slot]] = row
+        self._last_row[slot] = row
+        return row
+
+    def _set_row_count(self, row: int, count: int) -> None:
+        old = self._row_count[row]
+        if old.bit_length() != count.bit_length():
+            self._unindex(row, old)
+            self._index(row, count)
+        self._row_count[row] = count
+        if count == 0:
+            self._delete_row(row)
+
+    def _index(self, row: int, count: int) -> None:
+        bucket = count.bit_length() - 1
+        if bucket < 1: return
+        while len(self._buckets) <= bucket:
+            self._buckets.append(array('i'))
+        self._row_pos[row] = len(self._buckets[bucket])
+        self._buckets[bucket].append(row)
+
+    def _unindex(self, row: int, count: int) -> None:
+        bucket = count.bit_length() - 1
+        if bucket < 1: return
+        rows = self._buckets[bucket]
+        pos = self._row_pos[row]
+        last = rows.pop()
+        if last != row:
+            rows[pos] = last
+            self._row_pos[last] = pos
+        self._row_pos[row] = -1
+
+    def _delete_row(self, row: int) -> None:
+        """Unlink a row with zero count and free it, and its slot and name if it was their last row"""
+        slot = self._row_slot[row]
+        prev = -1
+        r = self._first_row[slot]
+        while r != row:
+            prev = r
+            r = self._row_next[r]
+        if prev == -1:
+            self._first_row[slot] = self._row_next[row]
+        else:
+            self._row_next[prev] = self._row_next[row]
+        if self._last_row[slot] == row:
+            self._last_row[slot] = prev
+
+        self._row_slot[row] = -1
+        self._row_next[row] = -1
+        self._free_rows.append(row)
+        name_id = self._row_name[row]
+        self._name_rows[name_id] -= 1
+        if self._name_rows[name_id] == 0:
+            del self._name_ids[self._names[name_id]]
+            self._names[name_id] = ''
+            self._free_names.append(name_id)
+        if self._first_row[slot] == -1:
+            self._delete_slot(slot)
+
+
+    def weight(self, hash_: bytes) -> int:
+        slot = self._table[self._probe(hash_)]
+        if slot == -1:
+            raise KeyError(hash_)
+        return self._weights[slot]
+
+    def counts(self, hash_: bytes) -> Iterator[Tuple[str, int]]:
+        """Get (name, count) of all packages with given hash, in insertion order"""
+        slot = self._table[self._probe(hash_)]
+        if slot == -1:
+            raise KeyError(hash_)
+        return self._slot_counts(slot)
+
+    def _slot_counts(self, slot: int) -> Iterator[Tuple[str, int]]:
+        row = self._first_row[slot]
+        while row != -1:
+            yield self._names[self._row_name[row]], self._row_count[row]
+            row = self._row_next[row]
+
+    def items(self) -> Iterator[Tuple[bytes, str, int]]:
+        """Get (hash, name, count) of all packages"""
+        for slot in range(len(self._weights)):
+            if self._first_row[slot] != -1:
+                hash_ = self._hash(slot)
+                for name, count in self._slot_counts(slot):
+                    yield hash_, name, count
+
+    def weights(self) -> Iterator[Tuple[bytes, int]]:
+        """Get (hash, weight) of all hashes which have a weight"""
+        for slot in range(len(self._weights)):
+            if self._first_row[slot] != -1 and self._weights[slot] != NoWeight:
+                yield self._hash(slot), self._weights[slot]
+
+    def at_least(self, threshold: int) -> Iterator[Tuple[bytes, str, int]]:
+        """Get (hash, name, weight) of packages with count at least `threshold`, ordered by hash
+        Only numbers of qualifying slots are sorted; rows are generated as they are consumed.
+        """
+        counts = self._row_count
+        if threshold <= 1:
+            slots: Iterable[int] = ( slot for slot in range(len(self._weights)) if self._first_row[slot] != -1 )
+        else:
+            slots = { self._row_slot[row] for rows in self._buckets[ threshold.bit_length() - 1 : ] for row in rows if counts[row] >= threshold }
+        for slot in sorted(slots, key=self._hash):
+            hash_ = self._hash(slot)
+            weight = self._weights[slot]
+            row = self._first_row[slot]
+            while row != -1:
+                if counts[row] >= threshold:
+                    yield hash_, self._names[self._row_name[row]], weight
+                row = self._row_next[row]
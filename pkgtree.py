@@ -3,8 +3,12 @@ from __future__ import annotations
 from common import *
 
 from .stub import *
+from . import stats
 
+from array import array
+from typing import Callable, Tuple
 import hashlib
+import sys
 
 
 def _get_invoked_apis(class_: DexClass, api_set: Set[str]) -> List[str]:
@@ -15,6 +19,15 @@ def _get_invoked_apis(class_: DexClass, api_set: Set[str]) -> List[str]:
                 ret.append(invoked_method)
     return ret
 
+def _get_invoked_api_ids(class_: DexClass, api_ids: Dict[str, int]) -> List[int]:
+    ret: List[int] = [ ]
+    for method in class_.methods():
+        for invoked_method in method.get_invoked_methods():
+            api_id = api_ids.get(invoked_method)
+            if api_id is not None:
+                ret.append(api_id)
+    return ret
+
 
 def _calc_hash(lst: list) -> bytes:
     ret = hashlib.sha1()
@@ -24,38 +37,103 @@ def _calc_hash(lst: list) -> bytes:
         ret.update(s)
     return ret.digest()
 
+def _calc_leaf_hash_v2(api_ids: List[int]) -> bytes:
+    ids = array('I', sorted(api_ids))
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return hashlib.blake2b(ids.tobytes(), digest_size=20).digest()
+
+def _calc_hash_v2(hashes: List[bytes]) -> bytes:
+    return hashlib.blake2b(b''.join(sorted(hashes)), digest_size=20).digest()
+
+
+# hash scheme -> (API extractor, leaf hash, package hash)
+# Scheme 1: SHA-1 over sorted API names; `api_set` is a set of API names
+# Scheme 2: BLAKE2b over packed sorted API ids; `api_set` maps API names to ids (see vocab.py)
+# Hashes of different schemes must never be mixed in one database
+HashSchemes: Dict[int, Tuple[Callable, Callable, Callable]] = {
+    1: (_get_invoked_apis, _calc_hash, _calc_hash),
+    2: (_get_invoked_api_ids, _calc_leaf_hash_v2, _calc_hash_v2),
+}
+
+def _calc_leaf(class_: DexClass, api_set: Union[Set[str], Dict[str, int]],
+        scheme: Tuple[Callable, Callable, Callable], pkg_apis: Optional[Dict[str, Set]]) -> Optional[Tuple[bytes, int]]:
+    """Get hash and weight of a class with functions of a hash scheme, or None if it does not invoke any API
+    Its APIs are added to those of its package in `pkg_apis`, if given.
+    """
+    get_apis, leaf_hash, _ = scheme
+    apis = get_apis(class_, api_set)
+    if len(apis) == 0:
+        return None
+    if pkg_apis is not None:
+        pkg_apis[class_.name().rsplit('/', 1)[0]].update(apis)
+    return leaf_hash(apis), len(apis)
+
+def _timed_scheme(hash_scheme: int) -> Tuple[Tuple[Callable, Callable, Callable], List[stats.Accumulator]]:
+    """Get functions of a hash scheme, which are timed while stats are enabled"""
+    scheme = HashSchemes[hash_scheme]
+    if not stats.enabled:
+        return scheme, [ ]
+    timers = [ stats.Accumulator(name) for name in [ 'tree.extract', 'tree.leaf_hash', 'tree.package_hash' ] ]
+    return cast(Any, tuple( timer.wrap(func) for timer, func in zip(timers, scheme) )), timers
+
 
 class PackageTree:
-    def __init__(self, dex: Dex, api_set: Set[str]) -> None:
-        # create empty tree
-        self.root: _TreeNode = _TreeNode('')
-        self.root.name = ''  # otherwise root.name will be 'L'
+    def __init__(self, dex: Dex, api_set: Union[Set[str], Dict[str, int]], hash_scheme: int = 1,
+            collect_apis: bool = False) -> None:
+        """If `collect_apis` is true, `pkg_apis` maps each package name to APIs invoked by its own classes
+        (as extracted by the hash scheme), e.g. for similarity signatures
+        """
+        with stats.phase('tree.build'):
+            scheme, timers = _timed_scheme(hash_scheme)
+            package_hash = scheme[2]
+            self.pkg_apis: Dict[str, Set] = defaultdict(set)
+
+            # create empty tree
+            self.root: _TreeNode = _TreeNode('')
+            self.root.name = ''  # otherwise root.name will be 'L'
 
-        # create tree nodes
-        for class_ in dex.classes:
-            name = class_.name()
-            assert name.startswith('L')
-            apis = _get_invoked_apis(class_, api_set)
-            if len(apis) == 0: continue
-            leaf = _TreeNode(name, _calc_hash(apis), len(apis))
-            self.root.add_leaf(leaf)
+            # create tree nodes
+            for class_ in dex.classes:
+                name = class_.name()
+                assert name.startswith('L')
+                leaf_info = _calc_leaf(class_, api_set, scheme, self.pkg_apis if collect_apis else None)
+                if leaf_info is None: continue
+                leaf = _TreeNode(name, *leaf_info)
+                self.root.add_leaf(leaf)
 
-        # calculate hash and weight
-        self.nodes: Dict[bytes, _TreeNode] = { cast(bytes, node.hash) : node for node in self.root.finish() }
+            # calculate hash and weight
+            nodes = self.root.finish(package_hash)
+            self.nodes: Dict[bytes, _TreeNode] = { cast(bytes, node.hash) : node for node in nodes }
+
+        if stats.enabled:
+            for timer in timers:
+                timer.flush()
+            stats.count('tree.leaves', sum( 1 for node in nodes if node.children is None ))
+            stats.count('tree.nodes', len(nodes))
+            stats.count('tree.hashes', len(self.nodes))
+
+
+    def pkgs(self) -> List[PkgInfo]:
+        """Get hash, name and weight of all nodes"""
+        return [ PkgInfo(hash_, node.name, cast(int, node.weight)) for hash_, node in self.nodes.items() ]
 
 
     def set_db_match_result(self, exact_libs: List[LibInfo]):
-        for lib in exact_libs:
-            node = self.nodes[lib.hash]
-            node.match_libs[lib.name] = cast(int, node.weight)
+        with stats.phase('tree.set_db_match_result'):
+            for lib in exact_libs:
+                node = self.nodes[lib.hash]
+                node.match_libs[lib.name] = cast(int, node.weight)
 
 
     def detect_libs(self, match_rate_threshold: float, whitelist: Set[str]) -> List[PkgResult]:
         """Calculate match rate of potential libraries, return matches above threshold
         exact_libs: list of perfectly matched libraries
         """
-        self.root.calc_match_rate()
-        self.root.gen_result(whitelist)
+        with stats.phase('tree.calc_match_rate'):
+            self.root.calc_match_rate()
+        with stats.phase('tree.gen_result'):
+            self.root.gen_result(whitelist)
 
         ret = [ ]
 
@@ -87,7 +165,22 @@ class PackageTree:
 
     def detect_exact_libs(self) -> Dict[str, str]:
         """Get perfectly matched libraries, excluding subpackages"""
-        return self.root.get_exact_libs()
+        with stats.phase('tree.exact_libs'):
+            return self.root.get_exact_libs()
+
+
+    def unmatched_pkgs(self, reported: Set[bytes]) -> List[PkgInfo]:
+        """Get packages which are neither perfectly matched nor `reported`, nor inside such packages
+        Call after `detect_libs`.
+        """
+        hashes = set()
+        stack = [ self.root ]
+        while stack:
+            node = stack.pop()
+            if node.children is None or node.hash in reported or node.is_perfect(): continue
+            hashes.add(node.hash)
+            stack += node.children.values()
+        return [ pkg for pkg in self.pkgs() if pkg.hash in hashes ]
 
 
 
@@ -129,15 +222,15 @@ class _TreeNode:
             children[next_name] = node
 
 
-    def finish(self) -> List[_TreeNode]:
+    def finish(self, calc_hash: Callable[[List[bytes]], bytes] = _calc_hash) -> List[_TreeNode]:
         """Calculate hash of self and each node in subtree; return a list of all nodes"""
         if self.children is None: return [ self ]  # hash of leaf nodes are calculated when create
 
         children_nodes: List[_TreeNode] = [ ]
         for c in self.children.values():
-            children_nodes += c.finish()
+            children_nodes += c.finish(calc_hash)
 
-        self.hash = _calc_hash([ cast(bytes, c.hash) for c in self.children.values() ])
+        self.hash = calc_hash([ cast(bytes, c.hash) for c in self.children.values() ])
         self.weight = sum( c.weight for c in self.children.values() )
         return [ self ] + children_nodes
 
@@ -175,6 +268,10 @@ class _TreeNode:
                 self.match_libs[pkg] = cast(int, self.weight)
 
 
+    def is_perfect(self) -> bool:
+        """Whether the package matches a library perfectly, so `gen_result` ignores its subpackages"""
+        return len(self.match_libs) > 0 and max(self.match_libs.values()) == self.weight
+
     def gen_result(self, whitelist: Set[str], parent_perfect = False) -> None:
         if self.children is None:  # assuming lib is always package instead of class
             return
@@ -202,7 +299,7 @@ class _TreeNode:
                         break
 
             self.result_match_weight = max_weight
-            perfect = (max_weight == self.weight)
+            perfect = self.is_perfect()
 
         else:
             perfect = False
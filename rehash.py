@@ -0,0 +1,52 @@
+"""Migrate a database to another hash scheme
+
+Hashes cannot be converted from one scheme to another, so the package database is
+rebuilt from the original APK corpus into an empty database, then the library
+database is regenerated from it. The old database is left untouched, so old and
+new hashes are never mixed.
+
+Usage: python -m library.rehash SCHEME OUTPUT_DIR APK_LIST_FILE
+Build an in-memory database with hash scheme SCHEME in OUTPUT_DIR, from APK files
+listed (one path per line) in APK_LIST_FILE.
+"""
+
+from common import *
+
+from .stub import *
+
+import os
+import sys
+
+
+def rehash(db: Any, apk_files: Iterable[Union[bytes, str]], hash_scheme: int) -> None:
+    """Rebuild package and library database in empty database `db` using `hash_scheme`
+    `db` becomes the active database
+    """
+    from . import set_database, add_apk_to_database, update_library_database
+
+    db.set_hash_scheme(hash_scheme)  # fails if `db` is not empty
+    set_database(db)
+
+    count = 0
+    for apk_file in apk_files:
+        add_apk_to_database(apk_file)
+        count += 1
+        if count % 1000 == 0:
+            lx.info('%d APKs rehashed' % count)
+
+    update_library_database()
+
+
+def main(argv: List[str]) -> None:
+    scheme, output_dir, apk_list = argv
+    apk_files = [ os.path.abspath(path) for path in lx.read_lines(apk_list) ]
+    os.makedirs(output_dir, exist_ok=True)
+    os.chdir(output_dir)  # in-memory database uses current directory
+
+    from . import memdb
+    rehash(memdb, apk_files, int(scheme))
+    memdb.dump()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,186 @@
+"""Versioned binary snapshot of the in-memory database
+
+Layout (little-endian, every section padded to 8 bytes):
+    header      magic, version, hash_scheme, n_names, names_size, n_libs, n_pkgs, n_weights, generation,
+                n_changed, journal epoch (see journal.py; reserved and 0 before journals)
+    names       (n_names + 1) x u32 offsets, followed by UTF-8 blob of interned package names
+    libs        n_libs x 20-byte hash (sorted), n_libs x u32 name id
+    pkgs        n_pkgs x 20-byte hash (sorted), n_pkgs x u32 name id, n_pkgs x i32 count
+    weights     n_weights x 20-byte hash (sorted), n_weights x u32 weight
+    changed     n_changed x 20-byte hash of packages changed since last library update
+
+The file is memory-mapped; lookups binary search the sorted hash columns
+without materializing any Python containers.
+"""
+
+from common import *
+
+from typing import Iterator, Tuple
+import bisect
+import mmap
+import os
+import struct
+
+
+Magic = b'LIBSNAP\0'
+Version = 3
+HashSize = 20
+
+_headers = {
+    1: struct.Struct('<8sIIIIII'),  # no hash scheme, always 1
+    2: struct.Struct('<8sIIIIIIII'),  # no changed hashes
+    3: struct.Struct('<8sIIIIIIIIII'),
+}
+
+
+class _HashColumn:
+    """Sequence view of a sorted fixed-width hash column, usable by `bisect`"""
+
+    def __init__(self, buf: memoryview, count: int) -> None:
+        self.buf = buf
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self.buf[ i * HashSize : (i + 1) * HashSize ])
+
+
+class Snapshot:
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+
+        magic, version = struct.unpack_from('<8sI', buf)
+        if magic != Magic:
+            raise ValueError('%s is not a database snapshot' % path)
+        if version not in _headers:
+            raise ValueError('Unsupported snapshot version %d' % version)
+
+        header = _headers[version]
+        if version == 1:
+            _, _, n_names, names_size, n_libs, n_pkgs, n_weights = header.unpack_from(buf)
+            self.hash_scheme = 1
+            self.generation = 0
+            self.epoch = 0
+            n_changed = 0
+        elif version == 2:
+            _, _, self.hash_scheme, n_names, names_size, n_libs, n_pkgs, n_weights, self.generation = \
+                    header.unpack_from(buf)
+            self.epoch = 0
+            n_changed = 0
+        else:
+            _, _, self.hash_scheme, n_names, names_size, n_libs, n_pkgs, n_weights, self.generation, n_changed, self.epoch = \
+                    header.unpack_from(buf)
+
+        pos = header.size
+        def take(size: int) -> memoryview:
+            nonlocal pos
+            ret = buf[ pos : pos + size ]
+            if len(ret) != size:
+                raise ValueError('%s is truncated' % path)
+            pos += _align(size)
+            return ret
+
+        self._name_offsets = take((n_names + 1) * 4).cast('I')
+        self._names = take(names_size)
+        self._libs = _HashColumn(take(n_libs * HashSize), n_libs)
+        self._lib_names = take(n_libs * 4).cast('I')
+        self._pkgs = _HashColumn(take(n_pkgs * HashSize), n_pkgs)
+        self._pkg_names = take(n_pkgs * 4).cast('I')
+        self._pkg_counts = take(n_pkgs * 4).cast('i')
+        self._weight_hashes = _HashColumn(take(n_weights * HashSize), n_weights)
+        self._weights = take(n_weights * 4).cast('I')
+        self._changed = _HashColumn(take(n_changed * HashSize), n_changed)
+
+    def name(self, name_id: int) -> str:
+        return str(self._names[ self._name_offsets[name_id] : self._name_offsets[name_id + 1] ], 'utf8')
+
+    def match_libs(self, hash_: bytes) -> List[str]:
+        """Get names of all libraries with given hash"""
+        i = bisect.bisect_left(self._libs, hash_)
+        ret = [ ]
+        while i < len(self._libs) and self._libs[i] == hash_:
+            ret.append(self.name(self._lib_names[i]))
+            i += 1
+        return ret
+
+    def libs(self) -> Iterator[Tuple[bytes, str]]:
+        for i in range(len(self._libs)):
+            yield self._libs[i], self.name(self._lib_names[i])
+
+    def lib_hashes(self) -> Iterator[bytes]:
+        """Get distinct hashes of libraries"""
+        last = None
+        for i in range(len(self._libs)):
+            hash_ = self._libs[i]
+            if hash_ != last:
+                yield hash_
+            last = hash_
+
+    def pkgs(self) -> Iterator[Tuple[bytes, str, int]]:
+        for i in range(len(self._pkgs)):
+            yield self._pkgs[i], self.name(self._pkg_names[i]), self._pkg_counts[i]
+
+    def weights(self) -> Iterator[Tuple[bytes, int]]:
+        for i in range(len(self._weight_hashes)):
+            yield self._weight_hashes[i], self._weights[i]
+
+    def changed(self) -> Iterator[bytes]:
+        for i in range(len(self._changed)):
+            yield self._changed[i]
+
+
+def write(path: str,
+        pkgs: Iterable[Tuple[bytes, str, int]],
+        libs: Iterable[Tuple[bytes, str]],
+        weights: Iterable[Tuple[bytes, int]],
+        hash_scheme: int = 1,
+        generation: int = 0,
+        changed: Iterable[bytes] = (),
+        epoch: int = 0) -> None:
+    """Write a snapshot atomically (to a temporary file which then replaces `path`)"""
+    name_ids: Dict[str, int] = { }
+    def intern(name: str) -> int:
+        return name_ids.setdefault(name, len(name_ids))
+
+    lib_rows = sorted( (hash_, intern(name)) for hash_, name in libs )
+    pkg_rows = sorted( (hash_, intern(name), cnt) for hash_, name, cnt in pkgs )
+    weight_rows = sorted(weights)
+    changed_rows = sorted(changed)
+
+    names = [ name.encode('utf8') for name in name_ids ]
+    offsets = [ 0 ]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        def put(data: bytes) -> None:
+            f.write(data)
+            f.write(b'\0' * (_align(len(data)) - len(data)))
+
+        f.write(_headers[Version].pack(Magic, Version, hash_scheme,
+                len(names), offsets[-1], len(lib_rows), len(pkg_rows), len(weight_rows), generation, len(changed_rows), epoch))
+        put(_pack('I', offsets))
+        put(b''.join(names))
+        put(b''.join( r[0] for r in lib_rows ))
+        put(_pack('I', [ r[1] for r in lib_rows ]))
+        put(b''.join( r[0] for r in pkg_rows ))
+        put(_pack('I', [ r[1] for r in pkg_rows ]))
+        put(_pack('i', [ r[2] for r in pkg_rows ]))
+        put(b''.join( r[0] for r in weight_rows ))
+        put(_pack('I', [ r[1] for r in weight_rows ]))
+        put(b''.join(changed_rows))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _align(size: int) -> int:
+    return (size + 7) & ~7
+
+def _pack(fmt: str, values: List[int]) -> bytes:
+    return struct.pack('<%d%s' % (len(values), fmt), *values)
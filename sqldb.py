@@ -1,57 +1,342 @@
+"""OrangeAPK MySQL database
+
+Tables and columns used by this module (hashes are 20-byte binary strings):
+    packages    hash, pkg_name, weight, count, changed (see `get_changed_hashes`)
+    libraries   hash, pkg_name, generation (see `refresh`), removed
+    meta        name primary key, value: hash_scheme, scheme 1 if missing; generation, last
+                generation taken by `add_libs` or `remove_libs`
+
+Databases created before some of them existed are migrated by `migrate`, which runs
+before the first query of each process, or with `python -m library.sqldb`. It only creates
+what is missing, so running it again does nothing.
+"""
+
 from common import *
 
 from .stub import *
+from . import vocab
+from .cache import LruCache
+from . import stats
 
+from typing import Iterator, Tuple
 import os
 
 
-api_set: Set[str] = set(lx.read_lines(lx.open_resource('apis.txt')))
-lib_set: Set[str] = set(lx.read_lines(lx.open_resource('libs.txt')))
+api_set: Set[str]
+api_ids: Dict[str, int]
+lib_set: Set[str]
+hash_scheme: int
+generation: int
+
+def __getattr__(name: str) -> Any:
+    # these attributes are loaded on first access
+    if name == 'api_set': return vocab.api_set()
+    if name == 'api_ids': return vocab.api_ids()
+    if name == 'lib_set': return vocab.lib_set()
+    if name == 'hash_scheme': return _get_hash_scheme()
+    if name == 'generation': return _get_generation()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+# hash -> pkg_name's, downloaded by `preload`
+_db: Optional[Dict[bytes, Set[str]]] = None
+
+# highest `libraries.generation` seen; each `add_libs` and `remove_libs` call writes a new generation
+# in one transaction, so `refresh` never sees part of a generation
+_generation: Optional[int] = None
+
+# writes are committed immediately
+durable = True
+
+##  Maximal number of hashes in one `where hash in` query, and package rows in one `commit_multi`
+QueryChunkSize = 1000
+WriteChunkSize = 10000
+
+##  Number of rows fetched at once by `get_pkgs`
+GetPkgsPageSize = 100000
+
+##  Number of hashes whose library names (possibly none) are cached in process
+LookupCacheSize = 1000000
+
+# hash -> tuple of pkg_name's, empty for hashes which are not libraries
+_lookup_cache = LruCache(LookupCacheSize)
+
+# hash scheme of all hashes in the database, stored in `meta` table, see `pkgtree.HashSchemes`
+_hash_scheme: Optional[int] = None
 
+# tables created by `migrate` if missing
+_Tables = {
+    'meta': 'create table meta (name varchar(32) not null primary key, value bigint not null)',
+}
 
-# hash -> pkg_name
-_db: Optional[Dict[bytes, str]] = None
+# columns added by `migrate` if missing; rows written before a column existed get its default
+_Columns = [
+    ('libraries', 'generation', 'bigint not null default 0'),
+    ('libraries', 'removed', 'tinyint not null default 0'),
+    ('packages', 'changed', 'tinyint not null default 0'),
+]
+
+# indexes created by `migrate`, unless an index of the table starts with the same columns
+_Indexes = [
+    ('libraries', 'libraries_generation', ('generation',)),  # `refresh`
+    ('packages', 'packages_changed', ('changed', 'hash')),  # `get_changed_hashes`
+    ('packages', 'packages_hash_name', ('hash', 'pkg_name')),  # keyset paging of `get_pkgs`
+]
+
+# the schema is checked once per process, see `migrate`
+_migrated = False
 
 
 def match_libs(hash_list: Iterable[bytes]) -> List[LibInfo]:
     """Find all perfectly matched libraries for a list of package hashs"""
-    if _db is None:
-        sql = 'select hash, pkg_name from libraries where hash in {ARGS}'
-        result = lx.query('library', sql, hash_list)
-    else:
-        result = [ (h, _db[h]) for h in hash_list if h in _db ]
-    return [ LibInfo(*record) for record in result ]
+    if _db is not None:
+        return [ LibInfo(h, name) for h in hash_list for name in _db.get(h, ()) ]
+
+    ret: List[LibInfo] = [ ]
+    missing: List[bytes] = [ ]
+    cache_hits = _lookup_cache.hits
+    for hash_ in hash_list:
+        names = _lookup_cache.get(hash_)
+        if names is None:
+            missing.append(hash_)
+        else:
+            ret += ( LibInfo(hash_, name) for name in names )
+
+    found: Dict[bytes, List[str]] = defaultdict(list)
+    sql = 'select hash, pkg_name from libraries where removed = 0 and hash in {ARGS}'
+    for i in range(0, len(missing), QueryChunkSize):
+        for hash_, name in _query(sql, missing[ i : i + QueryChunkSize ]):
+            found[bytes(hash_)].append(name)
+
+    for hash_ in missing:
+        names = tuple(found.get(hash_, ()))
+        _lookup_cache.put(hash_, names)
+        ret += ( LibInfo(hash_, name) for name in names )
+
+    if stats.enabled:
+        stats.count('db.lookup_cache.hits', _lookup_cache.hits - cache_hits)
+        stats.count('db.query_hashes', len(missing))
+    return ret
 
 def add_pkgs(pkgs: List[PkgInfo]) -> None:
     """Add a package to package database"""
-    sql = 'insert into packages (hash, pkg_name, weight, count) values (%s,%s,%s,1) ' + \
-            'on duplicate key update count = count + 1'
-    lx.commit_multi('library', sql, [ (pkg.hash, pkg.name, pkg.weight) for pkg in pkgs ])
+    sql = 'insert into packages (hash, pkg_name, weight, count, changed) values (%s,%s,%s,1,1) ' + \
+            'on duplicate key update count = count + 1, changed = 1'
+    _commit_chunks(sql, [ (pkg.hash, pkg.name, pkg.weight) for pkg in pkgs ])
+
+def add_pkg_counts(pkgs: List[Tuple[PkgInfo, int]]) -> None:
+    """Add packages to package database, each appearing `count` times"""
+    sql = 'insert into packages (hash, pkg_name, weight, count, changed) values (%s,%s,%s,%s,1) ' + \
+            'on duplicate key update count = count + values(count), changed = 1'
+    _commit_chunks(sql, [ (pkg.hash, pkg.name, pkg.weight, count) for pkg, count in pkgs ])
 
 def remove_pkgs(pkgs: List[PkgInfo]) -> None:
     """Remove a package from package database"""
-    sql = 'update packages set count = count - 1 where hash=%s and pkg_name=%s and weight=%s'
-    lx.commit_multi('library', sql, [ (pkg.hash, pkg.name, pkg.weight) for pkg in pkgs ])
+    sql = 'update packages set count = count - 1, changed = 1 where hash=%s and pkg_name=%s and weight=%s'
+    _commit_chunks(sql, [ (pkg.hash, pkg.name, pkg.weight) for pkg in pkgs ])
+
+def get_pkgs(threshold: int) -> Iterator[PkgInfo]:
+    """Get all packages which appear at least `threshold` times in the package database, ordered by hash
+    Rows are fetched page by page, continuing after the last row of previous page
+    """
+    sql = 'select hash, pkg_name, weight from packages where count >= %s order by hash, pkg_name limit %s'
+    rows = _query(sql, threshold, GetPkgsPageSize)
+    sql = 'select hash, pkg_name, weight from packages ' + \
+            'where count >= %s and (hash > %s or (hash = %s and pkg_name > %s)) ' + \
+            'order by hash, pkg_name limit %s'
+    while len(rows) > 0:
+        for hash_, pkg, weight in rows:
+            yield PkgInfo(bytes(hash_), pkg, weight)
+        if len(rows) < GetPkgsPageSize: break
+        last_hash, last_pkg = bytes(rows[-1][0]), rows[-1][1]
+        rows = _query(sql, threshold, last_hash, last_hash, last_pkg, GetPkgsPageSize)
+
+def get_changed_hashes() -> Set[bytes]:
+    """Get hashes of packages added or removed since they were last processed by library update"""
+    sql = 'select distinct hash from packages where changed = 1'
+    return { bytes(r[0]) for r in _query(sql) }
+
+def get_pkgs_of(hashes: Iterable[bytes], threshold: int) -> List[PkgInfo]:
+    """Get packages with given hashes which appear at least `threshold` times"""
+    hashes = list(hashes)
+    sql = 'select hash, pkg_name, weight, count from packages where hash in {ARGS}'
+    ret = [ ]
+    for i in range(0, len(hashes), QueryChunkSize):
+        for hash_, pkg, weight, count in _query(sql, hashes[ i : i + QueryChunkSize ]):
+            if count >= threshold:
+                ret.append(PkgInfo(bytes(hash_), pkg, weight))
+    return ret
 
-def get_pkgs(threshold: int) -> List[PkgInfo]:
-    """Get all packages which appear at least `threshold` times in the package database"""
-    sql = 'select hash, pkg_name, weight from packages where count >= %s'
-    return [ PkgInfo._make(r) for r in lx.query('library', sql, threshold) ]
+def clear_changed(hashes: Iterable[bytes]) -> None:
+    """Mark packages as processed by library update"""
+    sql = 'update packages set changed = 0 where hash = %s'
+    _commit_chunks(sql, [ (hash_,) for hash_ in hashes ])
+
+def get_lib_hashes() -> List[bytes]:
+    """Get hashes of all libraries"""
+    return [ bytes(r[0]) for r in _query('select distinct hash from libraries where removed = 0') ]
 
 def add_libs(libs: List[LibInfo]) -> None:
     """Add a library to library database"""
-    sql = 'insert ignore into libraries (hash, pkg_name) values (%s,%s)'
-    lx.commit_multi('library', sql, libs)
+    # re-added libraries get new generation so `refresh` can see them; existing ones are untouched
+    sql = 'insert into libraries (hash, pkg_name, generation, removed) values (%s,%s,%s,0) ' + \
+            'on duplicate key update generation = if(removed, values(generation), generation), removed = 0'
+    if len(libs) == 0: return
+    generation = _next_generation()
+    _commit(sql, [ (lib.hash, lib.name, generation) for lib in libs ])
+    _libs_changed()
+
+def remove_libs(libs: List[LibInfo]) -> None:
+    """Remove a library from library database"""
+    # rows are kept with a new generation so `refresh` can see the removal
+    sql = 'update libraries set removed = 1, generation = %s where hash = %s and pkg_name = %s and removed = 0'
+    if len(libs) == 0: return
+    generation = _next_generation()
+    _commit(sql, [ (generation, lib.hash, lib.name) for lib in libs ])
+    _libs_changed()
+
+def _next_generation() -> int:
+    """Take a new generation from `meta`
+    Its row stays locked until the following `_commit` commits the generation's rows, so writers
+    take generations one after another, and commit them in order.
+    """
+    _query("update meta set value = last_insert_id(value + 1) where name = 'generation'")
+    return int(_query('select last_insert_id()')[0][0])
+
+def _libs_changed() -> None:
+    global _generation
+    _lookup_cache.clear()
+    if _db is None:
+        _generation = None  # read again on next use
+    else:
+        refresh()
+
+def _commit_chunks(sql: str, rows: List[Any]) -> None:
+    for i in range(0, len(rows), WriteChunkSize):
+        _commit(sql, rows[ i : i + WriteChunkSize ])
+
+def _query(sql: str, *args: Any) -> Any:
+    if not _migrated: migrate()
+    with stats.phase('db.query'):
+        rows = lx.query('library', sql, *args)
+    if stats.enabled:
+        stats.count('db.queries')
+        stats.count('db.query_rows', len(rows))
+    return rows
+
+def _commit(sql: str, rows: List[Any]) -> None:
+    if not _migrated: migrate()
+    with stats.phase('db.commit'):
+        lx.commit_multi('library', sql, rows)
+    if stats.enabled:
+        stats.count('db.commits')
+        stats.count('db.write_rows', len(rows))
+
+
+def set_hash_scheme(scheme: int) -> None:
+    """Change hash scheme of an empty database
+    Use rehash.py to migrate a non-empty database
+    """
+    global _hash_scheme
+    if scheme == _get_hash_scheme(): return
+    for table in [ 'packages', 'libraries' ]:
+        if _query('select 1 from %s limit 1' % table):
+            raise ValueError('Cannot change hash scheme of a non-empty database')
+    sql = "insert into meta (name, value) values ('hash_scheme', %s) on duplicate key update value = %s"
+    _commit(sql, [ (scheme, scheme) ])
+    _hash_scheme = scheme
+
+def _get_hash_scheme() -> int:
+    global _hash_scheme
+    if _hash_scheme is None:
+        sql = "select value from meta where name = 'hash_scheme'"
+        result = _query(sql)
+        _hash_scheme = int(result[0][0]) if result else 1
+    return _hash_scheme
 
 
 def preload() -> None:
     """Download library database to memory for better performance"""
-    global _db
-    sql = 'select hash, pkg_name from libraries'
-    _db = { hash_: pkg for hash_, pkg in lx.query('library', sql) }
+    global _db, _generation
+    _db = defaultdict(set)
+    _generation = -1
+    refresh()
+
+def refresh() -> None:
+    """Catch up with libraries added or removed since last `preload` or `refresh`
+    Only new rows are downloaded if the database is preloaded;
+    otherwise cached lookups are dropped when the library database has changed.
+    """
+    global _generation
+    if _db is None:
+        old_generation = _generation
+        _generation = None
+        if _get_generation() != old_generation:
+            _lookup_cache.clear()
+        return
+
+    sql = 'select hash, pkg_name, generation, removed from libraries where generation > %s'
+    for hash_, pkg, generation, removed in _query(sql, _generation):
+        if removed:
+            _db[bytes(hash_)].discard(pkg)
+        else:
+            _db[bytes(hash_)].add(pkg)
+        _generation = max(cast(int, _generation), generation)
+
+def _get_generation() -> int:
+    global _generation
+    if _generation is None:
+        sql = 'select coalesce(max(generation), 0) from libraries'
+        _generation = int(_query(sql)[0][0])
+    return _generation
 
 def dump() -> None:
     lx.warning('Trying to dump SQL database')
 
 def load() -> None:
     lx.warning('Trying to load SQL database')
+
+
+def migrate() -> None:
+    """Create tables, columns, indexes and `meta` rows used by this module if they are missing
+    The schema is read first, so processes with read-only access to a migrated database run no DDL.
+    Adding a column with a default value is instant on MySQL 8; indexes are built online.
+    """
+    global _migrated
+    sql = 'select table_name from information_schema.tables where table_schema = database()'
+    tables = { r[0].lower() for r in lx.query('library', sql) }
+    for table, sql in _Tables.items():
+        if table not in tables:
+            lx.info('Creating table %s' % table)
+            _execute(sql)
+
+    sql = 'select column_name from information_schema.columns where table_schema = database() and table_name = %s'
+    for table, column, definition in _Columns:
+        if column not in { r[0].lower() for r in lx.query('library', sql, table) }:
+            lx.info('Adding column %s.%s' % (table, column))
+            _execute('alter table %s add column %s %s' % (table, column, definition))
+
+    sql = 'select index_name, column_name from information_schema.statistics ' + \
+            'where table_schema = database() and table_name = %s order by index_name, seq_in_index'
+    for table, index, columns in _Indexes:
+        indexes: Dict[str, List[str]] = defaultdict(list)
+        for index_name, column in lx.query('library', sql, table):
+            indexes[index_name].append(column.lower())
+        if not any( tuple(cols[ : len(columns) ]) == columns for cols in indexes.values() ):
+            lx.info('Creating index %s' % index)
+            _execute('create index %s on %s (%s)' % (index, table, ', '.join(columns)))
+
+    # generations written before the counter existed
+    if not lx.query('library', "select 1 from meta where name = 'generation'"):
+        sql = "insert ignore into meta (name, value) select 'generation', coalesce(max(generation), 0) from libraries"
+        lx.commit_multi('library', sql, [ () ])
+
+    _migrated = True
+
+def _execute(sql: str) -> None:
+    lx.query('library', sql)  # MySQL commits DDL statements implicitly
+
+
+if __name__ == '__main__':
+    migrate()
+    lx.info('Library database schema is up to date')
@@ -0,0 +1,252 @@
+"""Database in a single SQLite file, persistent and transactional without a database server
+
+Tables (hashes are 20-byte BLOBs):
+    packages    (hash, pkg_name) primary key, weight, count, changed
+    libraries   (hash, pkg_name) primary key
+    signatures  hash primary key, signature (see lsh.py)
+    meta        name primary key, value: hash_scheme and generation
+
+Primary key tables are stored without rowid, so lookups by hash read one B-tree.
+The file uses WAL mode: readers in other processes are not blocked by writes.
+"""
+
+from common import *
+
+from .stub import *
+from . import vocab
+from . import stats
+
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, Tuple
+import os
+import sqlite3
+import threading
+
+
+api_set: Set[str]
+api_ids: Dict[str, int]
+lib_set: Set[str]
+hash_scheme: int
+generation: int
+
+def __getattr__(name: str) -> Any:
+    # these attributes are loaded on first access
+    if name == 'api_set': return vocab.api_set()
+    if name == 'api_ids': return vocab.api_ids()
+    if name == 'lib_set': return vocab.lib_set()
+    if name == 'hash_scheme': return _get_meta('hash_scheme', 1)
+    if name == 'generation': return _get_meta('generation', 0)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+database_file = 'db.sqlite3'
+
+# writes are committed immediately
+durable = True
+
+##  Maximal number of hashes in one `where hash in` query, limited by the number of parameters
+##  of a statement (999 in old SQLite versions)
+QueryChunkSize = 900
+
+##  Number of rows fetched at once by `get_pkgs`
+GetPkgsPageSize = 100000
+
+_Schema = [
+    'create table if not exists packages (hash blob not null, pkg_name text not null, weight integer not null, ' +
+        'count integer not null, changed integer not null, primary key (hash, pkg_name)) without rowid',
+    # `get_pkgs` reads in primary key order, so this index of earlier versions only slowed down writes
+    'drop index if exists packages_count',
+    'create index if not exists packages_changed on packages (hash) where changed = 1',
+    'create table if not exists libraries (hash blob not null, pkg_name text not null, ' +
+        'primary key (hash, pkg_name)) without rowid',
+    'create table if not exists signatures (hash blob primary key, signature blob not null) without rowid',
+    'create table if not exists meta (name text primary key, value integer not null) without rowid',
+]
+
+# connection of current process; forked workers open their own
+_conn: Optional[sqlite3.Connection] = None
+_conn_pid = 0
+# the connection is shared by threads (e.g. the database thread of async API), one at a time
+_lock = threading.RLock()
+
+
+def match_libs(hash_list: Iterable[bytes]) -> List[LibInfo]:
+    """Find all perfectly matched libraries for a list of package hashs"""
+    hashes = list(hash_list)
+    ret = [ ]
+    for i in range(0, len(hashes), QueryChunkSize):
+        chunk = hashes[ i : i + QueryChunkSize ]
+        sql = 'select hash, pkg_name from libraries where hash in (%s)' % ','.join('?' * len(chunk))
+        ret += ( LibInfo(hash_, name) for hash_, name in _query(sql, chunk) )
+    return ret
+
+def add_pkgs(pkgs: List[PkgInfo]) -> None:
+    """Add a package to package database"""
+    _upsert_counts(Counter(pkgs).items())
+
+def add_pkg_counts(pkgs: List[Tuple[PkgInfo, int]]) -> None:
+    """Add packages to package database, each appearing `count` times"""
+    _upsert_counts(pkgs)
+
+def remove_pkgs(pkgs: List[PkgInfo]) -> None:
+    """Remove a package from package database
+    Counts do not go below zero, and packages which were never added are ignored. Rows at zero are
+    deleted once library update has processed their hash (see `clear_changed`), so the removal of
+    the last package of a hash still marks it changed.
+    """
+    rows = sorted( (pkg.hash, pkg.name, count) for pkg, count in Counter(pkgs).items() )
+    sql = 'update packages set count = max(count - ?, 0), changed = 1 where hash = ? and pkg_name = ?'
+    with _transaction() as conn:
+        conn.executemany(sql, ( (count, hash_, name) for hash_, name, count in rows ))
+    if stats.enabled:
+        stats.count('db.write_rows', len(rows))
+
+def _upsert_counts(pkgs: Iterable[Tuple[PkgInfo, int]]) -> None:
+    """Add `count` to each package, in one transaction
+    Rows are sorted by key, so consecutive upserts touch neighbouring B-tree pages.
+    One prepared statement executed per row is faster here than multi-row statements.
+    """
+    rows = sorted( (pkg.hash, pkg.name, pkg.weight, count) for pkg, count in pkgs )
+    sql = 'insert into packages (hash, pkg_name, weight, count, changed) values (?,?,?,?,1) ' + \
+            'on conflict (hash, pkg_name) do update set count = count + excluded.count, changed = 1'
+    with _transaction() as conn:
+        conn.executemany(sql, rows)
+    if stats.enabled:
+        stats.count('db.write_rows', len(rows))
+
+def get_pkgs(threshold: int) -> Iterator[PkgInfo]:
+    """Get all packages which appear at least `threshold` times in the package database, ordered by hash
+    Rows are fetched page by page, continuing after the last row of previous page; the row value
+    comparison lets each page start with a primary key search instead of a scan from the beginning
+    """
+    sql = 'select hash, pkg_name, weight from packages where count >= ? order by hash, pkg_name limit ?'
+    rows = _query(sql, (threshold, GetPkgsPageSize))
+    sql = 'select hash, pkg_name, weight from packages ' + \
+            'where (hash, pkg_name) > (?, ?) and count >= ? order by hash, pkg_name limit ?'
+    while len(rows) > 0:
+        for hash_, pkg, weight in rows:
+            yield PkgInfo(hash_, pkg, weight)
+        if len(rows) < GetPkgsPageSize: break
+        last_hash, last_pkg = rows[-1][0], rows[-1][1]
+        rows = _query(sql, (last_hash, last_pkg, threshold, GetPkgsPageSize))
+
+def get_changed_hashes() -> Set[bytes]:
+    """Get hashes of packages added or removed since they were last processed by library update"""
+    return { r[0] for r in _query('select distinct hash from packages where changed = 1') }
+
+def get_pkgs_of(hashes: Iterable[bytes], threshold: int) -> List[PkgInfo]:
+    """Get packages with given hashes which appear at least `threshold` times"""
+    hashes = list(hashes)
+    ret = [ ]
+    for i in range(0, len(hashes), QueryChunkSize):
+        chunk = hashes[ i : i + QueryChunkSize ]
+        sql = 'select hash, pkg_name, weight from packages where count >= ? and hash in (%s)' % ','.join('?' * len(chunk))
+        ret += ( PkgInfo(hash_, pkg, weight) for hash_, pkg, weight in _query(sql, [ threshold ] + chunk) )
+    return ret
+
+def clear_changed(hashes: Iterable[bytes]) -> None:
+    """Mark packages as processed by library update, and delete removed packages of these hashes"""
+    hashes = list(hashes)
+    with _transaction() as conn:
+        for i in range(0, len(hashes), QueryChunkSize):
+            chunk = hashes[ i : i + QueryChunkSize ]
+            args = ','.join('?' * len(chunk))
+            conn.execute('delete from packages where count = 0 and hash in (%s)' % args, chunk)
+            conn.execute('update packages set changed = 0 where hash in (%s)' % args, chunk)
+
+def add_signatures(signatures: Dict[bytes, bytes]) -> None:
+    with _transaction() as conn:
+        conn.executemany('insert or replace into signatures (hash, signature) values (?,?)', signatures.items())
+
+def get_lib_signatures() -> Iterator[Tuple[bytes, List[str], bytes]]:
+    sql = 'select l.hash, group_concat(l.pkg_name, char(10)), s.signature from libraries l ' + \
+            'join signatures s on s.hash = l.hash group by l.hash'
+    for hash_, names, signature in _query(sql):
+        yield hash_, sorted(names.split('\n')), signature
+
+def get_lib_hashes() -> List[bytes]:
+    """Get hashes of all libraries"""
+    return [ r[0] for r in _query('select distinct hash from libraries') ]
+
+def add_libs(libs: List[LibInfo]) -> None:
+    """Add a library to library database"""
+    with _transaction() as conn:
+        conn.executemany('insert or ignore into libraries (hash, pkg_name) values (?,?)', libs)
+        _next_generation(conn)
+
+def remove_libs(libs: List[LibInfo]) -> None:
+    """Remove a library from library database"""
+    with _transaction() as conn:
+        conn.executemany('delete from libraries where hash = ? and pkg_name = ?', libs)
+        _next_generation(conn)
+
+def _next_generation(conn: sqlite3.Connection) -> None:
+    conn.execute("insert into meta (name, value) values ('generation', 1) " +
+            'on conflict (name) do update set value = value + 1')
+
+
+def set_hash_scheme(scheme: int) -> None:
+    """Change hash scheme of an empty database
+    Use rehash.py to migrate a non-empty database
+    """
+    if scheme == _get_meta('hash_scheme', 1): return
+    with _transaction() as conn:
+        for table in [ 'packages', 'libraries' ]:
+            if conn.execute('select 1 from %s limit 1' % table).fetchall():
+                raise ValueError('Cannot change hash scheme of a non-empty database')
+        conn.execute("insert into meta (name, value) values ('hash_scheme', ?) " +
+                'on conflict (name) do update set value = excluded.value', (scheme,))
+
+def _get_meta(name: str, default: int) -> int:
+    rows = _query('select value from meta where name = ?', (name,))
+    return rows[0][0] if rows else default
+
+
+def preload() -> None:
+    pass  # SQLite caches pages of the file itself
+
+def refresh() -> None:
+    pass  # every query sees changes committed by other processes
+
+def dump() -> None:
+    lx.warning('Trying to dump SQLite database')
+
+def load() -> None:
+    """Reopen the database file, e.g. after it was replaced"""
+    global _conn
+    with _lock:
+        if _conn is not None and _conn_pid == os.getpid():
+            _conn.close()
+        _conn = None
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn, _conn_pid
+    if _conn is None or _conn_pid != os.getpid():
+        _conn = sqlite3.connect(database_file, check_same_thread=False)
+        _conn_pid = os.getpid()
+        _conn.execute('pragma journal_mode = wal')
+        _conn.execute('pragma synchronous = normal')  # committed transactions survive process crashes
+        with _conn:
+            for sql in _Schema:
+                _conn.execute(sql)
+    return _conn
+
+def _query(sql: str, args: Iterable[Any] = ()) -> List[Any]:
+    with _lock, stats.phase('db.query'):
+        rows = _connect().execute(sql, list(args)).fetchall()
+    if stats.enabled:
+        stats.count('db.queries')
+        stats.count('db.query_rows', len(rows))
+    return rows
+
+@contextmanager
+def _transaction() -> Iterator[sqlite3.Connection]:
+    """Commit statements executed in the `with` block at once, or none of them on error"""
+    with _lock, stats.phase('db.commit'):
+        conn = _connect()
+        with conn:
+            yield conn
+    if stats.enabled:
+        stats.count('db.commits')
@@ -0,0 +1,94 @@
+"""Opt-in instrumentation
+
+Records wall and CPU time of phases (tree building, API extraction, hashing, database
+round trips, match rate calculation, ...) and counters (classes, nodes, queries, rows).
+Disabled by default. Instrumented code checks `enabled` once per tree or per database
+call, and adds no work per class or node while disabled.
+"""
+
+from common import *
+
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import time
+
+
+enabled = False
+
+# called with phase or counter name and its new values, e.g. `('tree.build', { 'wall': 0.1, 'cpu': 0.1 })`
+# or `('db.queries', { 'count': 1 })`
+_callback: Optional[Callable[[str, Dict[str, float]], None]] = None
+
+# name -> [ calls, wall seconds, CPU seconds ]
+_phases: Dict[str, List[float]] = defaultdict(lambda: [ 0, 0.0, 0.0 ])
+# name -> count
+_counters: Dict[str, int] = defaultdict(int)
+
+
+def enable(callback: Optional[Callable[[str, Dict[str, float]], None]] = None) -> None:
+    global enabled, _callback
+    enabled = True
+    _callback = callback
+
+def disable() -> None:
+    global enabled, _callback
+    enabled = False
+    _callback = None
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    phases = { name: { 'calls': calls, 'wall': wall, 'cpu': cpu } for name, (calls, wall, cpu) in _phases.items() }
+    return { 'phases': phases, 'counters': dict(_counters) }
+
+def reset_stats() -> None:
+    _phases.clear()
+    _counters.clear()
+
+
+def record(name: str, wall: float, cpu: float, calls: int = 1) -> None:
+    phase = _phases[name]
+    phase[0] += calls
+    phase[1] += wall
+    phase[2] += cpu
+    if _callback is not None:
+        _callback(name, { 'wall': wall, 'cpu': cpu })
+
+def count(name: str, n: int = 1) -> None:
+    _counters[name] += n
+    if _callback is not None:
+        _callback(name, { 'count': n })
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Record time of a `with` block if enabled"""
+    if not enabled:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    yield
+    record(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+
+class Accumulator:
+    """Time many short calls, and record them as one phase on `flush`"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def wrap(self, func: Callable) -> Callable:
+        def timed(*args: Any) -> Any:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            ret = func(*args)
+            self.wall += time.perf_counter() - wall
+            self.cpu += time.process_time() - cpu
+            self.calls += 1
+            return ret
+        return timed
+
+    def flush(self) -> None:
+        if self.calls:
+            record(self.name, self.wall, self.cpu, self.calls)
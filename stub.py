@@ -1,5 +1,7 @@
 from common import *
 
+from typing import Tuple
+
 
 class PkgInfo(NamedTuple):
     hash: bytes # A unique hash calculated from all API calls
@@ -16,22 +18,36 @@ class PkgResult(NamedTuple):
     lib_name: str
     similarity: Optional[float]
 
+class BatchResult(NamedTuple):
+    apk: Union[bytes, str]  # The APK file as passed to batch functions
+    result: Any             # Detection result, or None if failed
+    error: Optional[str]    # Formatted traceback if failed, otherwise None
+
 class Thresholds(NamedTuple):
     LibMatchRate: float
     MinApiWeight: int
     MinLibCount: int
     PkgNameBlackList: Iterable[str]
+    MinSimilarity: float = 0.7
 
 
 class Database:
+    durable: bool  # whether writes survive without `dump`, assumed to be true if missing
     api_set: Set[str]
+    api_ids: Dict[str, int]  # only required by hash scheme 2
     lib_set: Set[str]
+    hash_scheme: int  # see `pkgtree.HashSchemes`, assumed to be 1 if missing
 
     @staticmethod
     def preload() -> None:
         """Download library database to memory for better performance"""
         raise NotImplementedError()
 
+    @staticmethod
+    def refresh() -> None:
+        """Catch up with changes made to library database by other processes"""
+        raise NotImplementedError()
+
     @staticmethod
     def match_libs(hash_list: Iterable[bytes]) -> List[LibInfo]:
         """Find all perfectly matched libraries for a list of package hashs"""
@@ -42,14 +58,36 @@ class Database:
         """Add a package to package database"""
         raise NotImplementedError()
 
+    @staticmethod
+    def add_pkg_counts(pkgs: List[Tuple[PkgInfo, int]]) -> None:
+        """Add packages to package database, each appearing `count` times (optional)"""
+        raise NotImplementedError()
+
     @staticmethod
     def remove_pkgs(pkgs: List[PkgInfo]) -> None:
         """Remove a package from package database"""
         raise NotImplementedError()
 
     @staticmethod
-    def get_pkgs(threshold: int) -> List[PkgInfo]:
-        """Get all packages which appear at least `threshold` times in the package database"""
+    def get_pkgs(threshold: int) -> Iterable[PkgInfo]:
+        """Get all packages which appear at least `threshold` times in the package database
+        May be a lazy iterator, whose packages must be ordered by hash; a list is sorted by caller
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def add_signatures(signatures: Dict[bytes, bytes]) -> None:
+        """Record MinHash signatures of packages, see lsh.py (optional, for similarity index)"""
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_lib_signatures() -> Iterable[Tuple[bytes, List[str], bytes]]:
+        """Get (hash, names, signature) of libraries with recorded signature (optional, for similarity index)"""
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_lib_hashes() -> Iterable[bytes]:
+        """Get hashes of all libraries (optional, for library filter)"""
         raise NotImplementedError()
 
     @staticmethod
@@ -57,6 +95,31 @@ class Database:
         raise NotImplementedError()
         """Add a library to library database"""
 
+    @staticmethod
+    def remove_libs(libs: List[LibInfo]) -> None:
+        """Remove a library from library database"""
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_changed_hashes() -> Set[bytes]:
+        """Get hashes of packages added or removed since they were last processed by library update"""
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_pkgs_of(hashes: Iterable[bytes], threshold: int) -> List[PkgInfo]:
+        """Get packages with given hashes which appear at least `threshold` times"""
+        raise NotImplementedError()
+
+    @staticmethod
+    def clear_changed(hashes: Iterable[bytes]) -> None:
+        """Mark packages as processed by library update"""
+        raise NotImplementedError()
+
+    @staticmethod
+    def set_hash_scheme(scheme: int) -> None:
+        """Change hash scheme of an empty database"""
+        raise NotImplementedError()
+
     @staticmethod
     def dump() -> None:
         """Dump in-memory databases to file system"""
@@ -66,3 +129,22 @@ class Database:
     def load() -> None:
         """Load databases from file system to memory"""
         raise NotImplementedError()
+
+
+class AsyncDatabase:
+    """`Database` whose lookup and write functions are coroutines, for async API
+    Other attributes and functions are the same as `Database`, and stay synchronous.
+    Synchronous databases also work with async API: their functions run in a separate thread.
+    """
+
+    @staticmethod
+    async def match_libs(hash_list: Iterable[bytes]) -> List[LibInfo]:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def add_pkgs(pkgs: List[PkgInfo]) -> None:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def add_signatures(signatures: Dict[bytes, bytes]) -> None:
+        raise NotImplementedError()
@@ -0,0 +1,140 @@
+"""Synthetic dex files for benchmarks
+
+`SyntheticDex` and `SyntheticClass` implement the part of `Dex` and `DexClass` used by
+this package, so its hot paths can be measured without real APKs.
+
+A corpus is a list of apps, one dex each. Every app contains its own code plus a
+random subset of shared libraries, with popular libraries appearing in most apps and
+a long tail appearing in few. A library may appear under its original name, under
+the app's package (repackaged), or with all names obfuscated, and sometimes as a
+slightly different version. Invoked methods are drawn from apis.txt.
+"""
+
+from common import *
+
+from . import vocab
+
+from typing import Iterator, Tuple
+import hashlib
+import itertools
+import random
+import string
+
+
+Words = [ 'core', 'util', 'internal', 'net', 'io', 'ui', 'widget', 'cache', 'model', 'api', 'impl', 'common' ]
+TopLevels = [ 'com', 'com', 'com', 'org', 'io', 'net', 'cn' ]
+
+
+class SyntheticMethod:
+    def __init__(self, invoked_methods: List[str]) -> None:
+        self._invoked_methods = invoked_methods
+
+    def get_invoked_methods(self) -> List[str]:
+        return self._invoked_methods
+
+
+class SyntheticClass:
+    def __init__(self, name: str, methods: List[List[str]]) -> None:
+        self._name = name
+        self._methods = [ SyntheticMethod(invoked) for invoked in methods ]
+
+    def name(self) -> str:
+        return self._name
+
+    def methods(self) -> List[SyntheticMethod]:
+        return self._methods
+
+    def bytecode(self) -> bytes:
+        return '\n'.join( ' '.join(m.get_invoked_methods()) for m in self._methods ).encode('utf8')
+
+
+class SyntheticDex:
+    def __init__(self, classes: List[SyntheticClass]) -> None:
+        self.classes = classes
+
+    def signature(self) -> bytes:
+        ret = hashlib.sha1()
+        for class_ in self.classes:
+            ret.update(class_.name().encode('utf8'))
+            ret.update(class_.bytecode())
+        return ret.digest()
+
+
+# classes as (path segments, methods); the first segments are the package
+_Classes = List[Tuple[List[str], List[List[str]]]]
+
+
+def generate_code(rng: random.Random, root: List[str], class_count: int, apis: List[str]) -> _Classes:
+    """Generate classes of one library or app under package `root`"""
+    api_pool = rng.sample(apis, min(len(apis), 200))
+    packages = [ root ]
+    for _ in range(max(1, class_count // 8)):
+        parent = rng.choice(packages)
+        if len(parent) - len(root) < 3:
+            packages.append(parent + [ rng.choice(Words) + str(len(packages)) ])
+
+    ret = [ ]
+    for i in range(class_count):
+        package = rng.choice(packages)
+        methods = [ ]
+        for _ in range(rng.randint(1, 8)):
+            invoked = [ ]
+            for _ in range(rng.randint(0, 12)):
+                if rng.random() < 0.7:
+                    invoked.append(rng.choice(api_pool))
+                else:  # call inside the library, not an API
+                    invoked.append('L%s/C%d;->m%d' % ('/'.join(root), rng.randrange(class_count), rng.randrange(8)))
+            methods.append(invoked)
+        ret.append( (package + [ 'C%d' % i ], methods) )
+    return ret
+
+
+def generate_libraries(count: int) -> List[_Classes]:
+    """Generate `count` libraries; library i is the same regardless of `count`"""
+    apis = sorted(vocab.api_set())
+    ret = [ ]
+    for i in range(count):
+        rng = random.Random('lib%d' % i)
+        root = [ rng.choice(TopLevels), 'vendor%d' % i, rng.choice(Words) ]
+        ret.append(generate_code(rng, root, int(rng.lognormvariate(3, 0.8)) + 3, apis))
+    return ret
+
+
+def generate_corpus(app_count: int, library_count: int, seed: Any = 0) -> List[SyntheticDex]:
+    """Generate `app_count` apps using `library_count` shared libraries"""
+    apis = sorted(vocab.api_set())
+    libraries = generate_libraries(library_count)
+    rng = random.Random(seed)
+    ret = [ ]
+    for app in range(app_count):
+        app_root = [ 'com', 'app%d' % app ]
+        classes = generate_code(rng, app_root, rng.randint(20, 200), apis)
+        short_names = _short_names()
+        obfuscated: Dict[str, str] = defaultdict(lambda: next(short_names))  # injective, so package structure is kept
+
+        for i, library in enumerate(libraries):
+            if rng.random() >= 0.9 * (i + 1) ** -0.7:
+                continue
+            placement = rng.random()
+            new_version = rng.random() < 0.1
+            for segments, methods in library:
+                if new_version and rng.random() < 0.3:
+                    methods = methods[ : -1 ] or [ [ rng.choice(apis) ] ]
+                if placement < 0.15:
+                    segments = app_root + [ 'thirdparty' ] + segments
+                elif placement < 0.3:
+                    segments = [ obfuscated[s] for s in segments ]
+                classes.append( (segments, methods) )
+
+        rng.shuffle(classes)
+        ret.append(SyntheticDex([ SyntheticClass('L' + '/'.join(segments), methods) for segments, methods in classes ]))
+    return ret
+
+
+def _short_names() -> Iterator[str]:
+    """a, b, ..., z, aa, ab, ..., except top-level packages of other libraries"""
+    for length in itertools.count(1):
+        for letters in itertools.product(string.ascii_lowercase, repeat=length):
+            name = ''.join(letters)
+            if name not in TopLevels:
+                yield name
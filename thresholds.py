@@ -9,3 +9,6 @@ MinLibCount = 10
 
 ##  Thes packages should be omitted from database
 PkgNameBlackList = [ 'Lcn', 'Lcom', 'Lnet', 'Lorg' ]
+
+##  Minimal estimated API set similarity for a near match to be reported (only with similarity index)
+MinSimilarity = 0.7
@@ -0,0 +1,32 @@
+"""API vocabulary and library whitelist, loaded from resources on first use"""
+
+from common import *
+
+
+_api_set: Optional[Set[str]] = None
+_lib_set: Optional[Set[str]] = None
+_api_ids: Optional[Dict[str, int]] = None
+
+
+def api_set() -> Set[str]:
+    """Android APIs whose invocations are used as package features"""
+    global _api_set
+    if _api_set is None:
+        _api_set = set(lx.read_lines(lx.open_resource('apis.txt')))
+    return _api_set
+
+def lib_set() -> Set[str]:
+    """Whitelist of known library package names, in lower case"""
+    global _lib_set
+    if _lib_set is None:
+        _lib_set = set(lx.read_lines(lx.open_resource('libs.txt')))
+    return _lib_set
+
+def api_ids() -> Dict[str, int]:
+    """Map each API to a stable integer id (its line number in apis.txt)
+    apis.txt must only be appended to, or ids and hash scheme 2 fingerprints will change
+    """
+    global _api_ids
+    if _api_ids is None:
+        _api_ids = { api: i for i, api in enumerate(lx.read_lines(lx.open_resource('apis.txt'))) }
+    return _api_ids